@@ -0,0 +1,44 @@
+import argparse
+import json
+import sys
+
+# compare two bench-pipeline.py result files stage by stage, exits 1 when a stage regressed past the threshold
+def load(file_name):
+    with open(file_name) as results_file:
+        results = json.load(results_file)
+    return results, {stage["stage"]: stage for stage in results["stages"]}
+
+def ratio(new, old):
+    return new / old if old else None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files.")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=1.2, help="flag stages this many times slower or bigger")
+    args = parser.parse_args()
+
+    baseline, baseline_stages = load(args.baseline)
+    candidate, candidate_stages = load(args.candidate)
+    if baseline["rows"] != candidate["rows"] or baseline["backend"] != candidate["backend"]:
+        print(f"Warning: comparing {baseline['rows']} rows on {baseline['backend']} with {candidate['rows']} rows on {candidate['backend']}")
+
+    print(f"{baseline['version']} -> {candidate['version']}")
+    print(f"{'stage':>18} {'seconds':>17} {'ratio':>6} {'peak MB':>15} {'ratio':>6}")
+    regressions = []
+    for stage, new in candidate_stages.items():
+        old = baseline_stages.get(stage)
+        if old is None:
+            print(f"{stage:>18} {'':>17} {'new':>6}")
+            continue
+        time_ratio = ratio(new["seconds"], old["seconds"])
+        rss_ratio = ratio(new["peak_rss_mb"], old["peak_rss_mb"])
+        flag = ""
+        if (time_ratio or 0) > args.threshold or (rss_ratio or 0) > args.threshold:
+            regressions.append(stage)
+            flag = " <-"
+        print(f"{stage:>18} {old['seconds']:>8.3f}{new['seconds']:>9.3f} {time_ratio or 0:>6.2f} {old['peak_rss_mb']:>7.0f}{new['peak_rss_mb']:>8.0f} {rss_ratio or 0:>6.2f}{flag}")
+
+    if len(regressions) > 0:
+        print(f"Regressed: {', '.join(regressions)}")
+        sys.exit(1)
@@ -0,0 +1,242 @@
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+from datetime import datetime
+
+ROOT = path.join(path.dirname(path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import cv_snapshot
+import bench_data
+from mock_arcgis import MockFeatureServer
+
+# end to end benchmark of the ingest and stats jobs against local stand-ins
+#   fetch             - cv-api.py fetch_pages from the mock FeatureServer
+#   transform         - cv-api.py transform_page over generated pages
+#   store_data        - cv-api.py store_pages into an empty florida collection (time spent generating pages excluded)
+#   snapshot          - cv_snapshot.write_snapshot (only with --snapshot)
+#   cum_sum           - cv-stats.py constructor + cum_sum
+#   push_stats        - cv-stats.py push_stats, including the forecasts
+#   cum_sum_by_county - cv-county-stats.py constructor + cum_sum_all_counties + cum_sum_by_county for the top five
+STAGES = ["fetch", "transform", "store_data", "snapshot", "cum_sum", "push_stats", "cum_sum_by_county"]
+
+# the job scripts have hyphenated names, load them as modules
+def load_script(file_name, module_name):
+    spec = importlib.util.spec_from_file_location(module_name, path.join(ROOT, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# peak RSS of this process in MB, reset between stages where the kernel allows it (Linux 4.0+)
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+# wraps a page iterator and keeps the time spent producing pages, so the consumer can be timed alone
+class TimedPages():
+    def __init__(self, pages):
+        self.pages = iter(pages)
+        self.seconds = 0.0
+        self.rows = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            page = next(self.pages)
+        finally:
+            self.seconds += time.perf_counter() - start
+        self.rows += len(page)
+        return page
+
+class Benchmark():
+    def __init__(self, args):
+        self.args = args
+        self.results = []
+        self.stage_scope = "stage" if reset_peak_rss() else "process"
+        self.log = None if args.verbose else open(os.devnull, "w")
+
+    # run one stage, fn returns (rows, excluded seconds, extra fields)
+    def run(self, stage, fn):
+        if stage in self.args.skip:
+            return
+        reset_peak_rss()
+        rss_before = peak_rss_mb()
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        with contextlib.redirect_stdout(self.log) if self.log else contextlib.nullcontext():
+            rows, excluded, extra = fn()
+        seconds = time.perf_counter() - start - excluded
+        result = dict({
+            "stage": stage,
+            "rows": rows,
+            "seconds": round(seconds, 3),
+            "cpu_seconds": round(time.process_time() - cpu_start, 3),
+            "rows_per_second": round(rows / seconds) if seconds > 0 else None,
+            "rss_before_mb": round(rss_before, 1),
+            "peak_rss_mb": round(peak_rss_mb(), 1)
+        }, **extra)
+        self.results.append(result)
+        print(f"{stage:>18}: {result['seconds']:>9.3f}s {result['rows_per_second'] or 0:>10} rows/s  peak {result['peak_rss_mb']:.0f} MB", file=sys.stderr)
+
+# mongomock keeps everything in this process, --mongo-url points at a real (local) server instead
+def connect(args):
+    if args.mongo_url:
+        from pymongo import MongoClient
+        client = MongoClient(args.mongo_url)
+        client.drop_database(args.database)
+        return client, "mongodb"
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("mongomock is not installed, pip install mongomock or pass --mongo-url")
+    return mongomock.MongoClient(), "mongomock"
+
+def git_version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(args):
+    # the stats jobs read datasets/ relative to the working directory
+    os.chdir(ROOT)
+    client, backend = connect(args)
+    snapshot_dir = tempfile.mkdtemp(prefix="cv-bench-snapshot-")
+    config = {
+        "mongodb": {"url": args.mongo_url, "database": args.database, "sync": "diff"},
+        "other": {"dashboard_url": None, "snapshot_dir": snapshot_dir},
+        "smtp": {},
+        "api": {
+            "url": None,
+            "daily_url": None,
+            "concurrency": args.concurrency,
+            "requests_per_second": args.requests_per_second,
+            "max_in_flight_pages": 2 * args.concurrency,
+            "incremental": True,
+        }
+    }
+
+    cv_api = load_script("cv-api.py", "cv_api")
+    cv_stats = load_script("cv-stats.py", "cv_stats")
+    cv_county_stats = load_script("cv-county-stats.py", "cv_county_stats")
+    bench = Benchmark(args)
+
+    with MockFeatureServer(args.rows, args.seed, args.throttle) as server:
+        config["api"]["url"] = server.url
+        bot = cv_api.Coronavirus(config, client)
+        bot.records_per_page = args.page_size
+
+        def fetch():
+            received = {"bytes": 0}
+            bot.session.hooks["response"].append(lambda response, *a, **k: received.update(bytes=received["bytes"] + len(response.content)))
+            rows = sum(len(features) for features in bot.fetch_pages("1>0", args.rows))
+            return rows, 0.0, {"bytes": received["bytes"], "requests_per_second": args.requests_per_second, "concurrency": args.concurrency}
+        bench.run("fetch", fetch)
+
+    def generated_pages():
+        return (features for offset, features in bench_data.make_pages(args.rows, args.page_size, args.seed))
+
+    def transform():
+        pages = TimedPages(generated_pages())
+        high_water = {"max_object_id": 0, "max_case1": 0}
+        rows = 0
+        for features in pages:
+            rows += len(bot.transform_page(features, high_water))
+        return rows, pages.seconds, {}
+    bench.run("transform", transform)
+
+    def store_data():
+        high_water = {"max_object_id": 0, "max_case1": 0}
+        pages = TimedPages(bot.transform_page(features, high_water) for features in generated_pages())
+        result = bot.store_pages(pages, "florida")
+        if not result["success"]:
+            raise Exception(result["message"])
+        return pages.rows, pages.seconds, {"inserted": result["inserted"]}
+    bench.run("store_data", store_data)
+
+    if args.snapshot:
+        bench.run("snapshot", lambda: (args.rows, 0.0, {"version": cv_snapshot.write_snapshot(bot.db, snapshot_dir)}))
+
+    stats = {}
+    def cum_sum():
+        stats["job"] = cv_stats.CoronavirusStats(config, client)
+        return args.rows, 0.0, {"days": len(stats["job"].cum_sum())}
+    bench.run("cum_sum", cum_sum)
+
+    def push_stats():
+        stats["job"].push_stats(recalculate_sim=True)
+        return args.rows, 0.0, {}
+    if "job" in stats:
+        bench.run("push_stats", push_stats)
+
+    def cum_sum_by_county():
+        county_stats = cv_county_stats.CoronavirusStats(config, client)
+        all_counties = county_stats.cum_sum_all_counties()
+        data = county_stats.cum_sum_by_county(county_stats.get_top_five_counties(all_counties), all_counties)
+        return args.rows, 0.0, {"county_days": len(all_counties), "top_five_rows": len(data)}
+    bench.run("cum_sum_by_county", cum_sum_by_county)
+    shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+    return {
+        "benchmark": "pipeline",
+        "version": git_version(),
+        "created": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "backend": backend,
+        "rows": args.rows,
+        "page_size": args.page_size,
+        "seed": args.seed,
+        "peak_rss_scope": bench.stage_scope,
+        "stages": bench.results
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the ingest and stats stages against a mock FeatureServer and a local Mongo stand-in.")
+    parser.add_argument("--rows", type=int, default=20000, help="synthetic case lines, up to 10M (use --mongo-url past ~50k)")
+    parser.add_argument("--page-size", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests-per-second", type=float, default=1000)
+    parser.add_argument("--throttle", type=int, default=0, help="mock server answers every nth request with a 429")
+    parser.add_argument("--mongo-url", default=None, help="local MongoDB to use instead of mongomock, e.g. mongodb://localhost:27017")
+    parser.add_argument("--database", default="cv_bench", help="database to use (it is dropped first)")
+    parser.add_argument("--snapshot", action="store_true", help="write the columnar snapshot and run the stats jobs from it")
+    parser.add_argument("--skip", nargs="*", default=[], choices=STAGES, help="stages to leave out")
+    parser.add_argument("--output", default=None, help="write results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="keep the jobs' own output")
+    args = parser.parse_args()
+
+    results = main(args)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,60 @@
+import json
+import sys
+import time
+from os import path
+from datetime import datetime
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+import cv_transform
+import cv_counties
+import bench_data
+
+# the per-row loop cv-api.py used before the columnar transform, plus the county code
+def transform_rows(features, counties):
+    cases = []
+    for row in features:
+        attributes = row["attributes"]
+        travel_string = attributes["Origin"]
+        travel_list = [ item.strip().title() if ((item is not None) and len(item.strip()) > 2) else item.strip() for item in travel_string.split(";") ] if travel_string != "NA" else None
+        case = {
+            "case_number": attributes["ObjectId"],
+            "county": attributes["County"],
+            "county_code": counties.code(attributes["County"]),
+            "age": int(attributes["Age"]) if (attributes["Age"] != "NA" and attributes["Age"] != None) else None,
+            "sex": attributes["Gender"],
+            "travel": attributes["Travel_related"],
+            "travel_detail": travel_list,
+            "contact_with_confirmed_case": attributes["Contact"].title() if attributes["Contact"] != "NA" else "No",
+            "date_added": datetime.fromtimestamp(attributes["Case1"] / 1000.0).replace(hour=0, minute=0, second=0, microsecond=0),
+            "deceased": attributes["Died"] if attributes["Died"] != "NA" else "No",
+            "location": counties.location(counties.code(attributes["County"])),
+            "hospitalized": attributes["Hospitalized"].title() if (attributes["Hospitalized"] is not None and attributes["Hospitalized"] != "NA") else None,
+            "ed_visit": attributes["EDvisit"].title() if ((attributes["EDvisit"] is not None) and attributes["EDvisit"] != "NA") else None,
+        }
+        cases.append(case)
+
+    return cases
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    page_size = 2000
+    counties = cv_counties.registry()
+    pages = [features for offset, features in bench_data.make_pages(rows, page_size)]
+
+    legacy, legacy_seconds = timed(lambda: [case for page in pages for case in transform_rows(page, counties)])
+    tables, columnar_seconds = timed(lambda: [cv_transform.transform_features(page, counties) for page in pages])
+    columnar = [case for table in tables for case in table.to_records()]
+
+    print(json.dumps({
+        "rows": rows,
+        "page_size": page_size,
+        "row_loop_seconds": round(legacy_seconds, 3),
+        "columnar_seconds": round(columnar_seconds, 3),
+        "speedup": round(legacy_seconds / columnar_seconds, 2),
+        "identical": legacy == columnar
+    }, indent=2))
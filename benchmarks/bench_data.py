@@ -0,0 +1,55 @@
+import math
+import random
+import sys
+from itertools import accumulate
+from os import path
+from datetime import datetime, timedelta
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+import cv_counties
+
+# synthetic case line data for the benchmarks, attributes follow the ArcGIS case line layer read by cv-api.py
+# pages are generated from (seed, offset) alone, so any page of a 10M row feed can be produced on demand
+FIRST_DAY = datetime(2020, 3, 1)
+DAYS = 120
+
+ORIGINS = ["NA", "NA", "NA", "NA", "NY", "Italy", "Canada; NY; PA", "cruise; Egypt", "Spain", "NJ"]
+
+# counties weighted by population, plus the odd "Unknown" row seen in the feed
+def county_weights():
+    counties = cv_counties.registry()
+    names = counties.names + ["Unknown"]
+    weights = counties.population.tolist() + [int(counties.population.sum()) // 500]
+    return names, list(accumulate(weights))
+
+# epoch milliseconds of a case day, later days get more cases like the real curve
+def case1(rng):
+    day = int(DAYS * math.sqrt(rng.random()))
+    return int((FIRST_DAY + timedelta(days=day) - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+# features with ObjectId offset + 1 .. offset + count
+def make_page(offset, count, seed=0, counties=None):
+    rng = random.Random(seed * 1000003 + offset)
+    names, weights = counties or county_weights()
+    features = []
+    for object_id in range(offset + 1, offset + count + 1):
+        features.append({"attributes": {
+            "ObjectId": object_id,
+            "Case1": case1(rng),
+            "County": rng.choices(names, cum_weights=weights)[0],
+            "Age": str(rng.randrange(100)) if rng.random() < 0.97 else "NA",
+            "Gender": rng.choice(["Male", "Female", "Female", "Male", "Unknown"]),
+            "Travel_related": rng.choice(["Yes", "No", "No", "No", "Unknown"]),
+            "Origin": rng.choice(ORIGINS),
+            "Contact": rng.choice(["YES", "NO", "NA", "UNKNOWN"]),
+            "Died": "Yes" if rng.random() < 0.03 else "NA",
+            "Hospitalized": rng.choice(["YES", "NO", "NO", "UNKNOWN", "NA", None]),
+            "EDvisit": rng.choice(["YES", "NO", "NO", "NA", None]),
+        }})
+    return features
+
+# yield (offset, features) pages covering rows 0 .. rows
+def make_pages(rows, page_size=2000, seed=0, start=0):
+    counties = county_weights()
+    for offset in range(start, rows, page_size):
+        yield offset, make_page(offset, min(page_size, rows - offset), seed, counties)
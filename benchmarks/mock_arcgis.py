@@ -0,0 +1,117 @@
+import json
+import re
+import sys
+import threading
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import bench_data
+
+# local stand-in for the case line FeatureServer query endpoint
+#   GET /query?where=...&returnCountOnly=true          -> {"count": n}
+#   GET /query?where=...&resultOffset=&resultRecordCount= -> {"features": [...]}
+#   GET /?f=json                                        -> layer metadata with editingInfo.lastEditDate and an ETag
+# only the "ObjectId > n" clause of the where parameter is honoured, that's all cv-api.py sends
+# throttle=n answers every nth request with a 429 to exercise the client's backoff
+OBJECT_ID_FILTER = re.compile(r"ObjectId\s*>\s*(\d+)")
+
+class FeatureServerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            throttled = server.throttle > 0 and server.requests % server.throttle == 0
+        if throttled:
+            self.send_json({"error": "Too Many Requests"}, status=429, headers={"Retry-After": "0"})
+            return
+
+        url = urlparse(self.path)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        if not url.path.endswith("/query"):
+            self.send_layer()
+            return
+
+        match = OBJECT_ID_FILTER.search(params.get("where", ""))
+        first = min(int(match.group(1)), server.rows) if match else 0
+        available = server.rows - first
+
+        if params.get("returnCountOnly", "false") == "true":
+            self.send_json({"count": available})
+            return
+
+        offset = first + int(params.get("resultOffset", 0))
+        count = max(0, min(int(params.get("resultRecordCount", 2000)), server.rows - offset))
+        features = bench_data.make_page(offset, count, server.seed, server.counties) if count > 0 else []
+        self.send_json({"features": features, "exceededTransferLimit": offset + count < server.rows})
+
+    # the synthetic table only changes with its size and seed
+    def send_layer(self):
+        etag = f'"{self.server.rows}-{self.server.seed}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_json({
+            "name": "Florida_COVID19_Case_Line_Data",
+            "editingInfo": {"lastEditDate": 1585699200000 + self.server.rows + self.server.seed}
+        }, headers={"ETag": etag})
+
+    def send_json(self, data, status=200, headers={}):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(rows, seed, throttle, port, ready):
+    server = ThreadingHTTPServer(("127.0.0.1", port), FeatureServerHandler)
+    server.daemon_threads = True
+    server.rows = rows
+    server.seed = seed
+    server.throttle = throttle
+    server.counties = bench_data.county_weights()
+    server.requests = 0
+    server.lock = threading.Lock()
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+# run the server in its own process so it doesn't share the GIL or RSS with the stage being measured
+class MockFeatureServer():
+    def __init__(self, rows, seed=0, throttle=0, port=0):
+        self.rows = rows
+        self.seed = seed
+        self.throttle = throttle
+        self.port = port
+        self.process = None
+
+    def __enter__(self):
+        ready = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=serve, args=(self.rows, self.seed, self.throttle, self.port, ready), daemon=True)
+        self.process.start()
+        self.port = ready.get(timeout=30)
+        return self
+
+    def __exit__(self, *args):
+        self.process.terminate()
+        self.process.join()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}/query"
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+    print(f"Serving {rows} synthetic cases on http://127.0.0.1:{port}/query")
+    serve(rows, 0, 0, port, None)
@@ -0,0 +1,207 @@
+from datetime import datetime, timedelta
+import numpy as np
+import cv_config
+import cv_daily
+import cv_metrics
+import cv_counties
+import cv_cube
+import cv_rolling
+
+class CoronavirusAnalytics():
+    # constructor
+    def __init__(self, config=None, client=None, counts=None):
+        # read config, if config.json file is not available then try OS environment vars
+        self.config = config if config is not None else cv_config.load_config()
+
+        # per stage timings and counters, Mongo commands are counted by the listener
+        self.metrics = cv_metrics.Metrics("cv-analytics", self.config)
+
+        # connect to MongoDB/Atlas
+        self.client = client if client is not None else cv_config.get_client(self.config)
+        self.db = self.client.get_database(self.config["mongodb"]["database"])
+        self.counties = cv_counties.registry()
+        self.snapshot_dir = self.config["other"].get("snapshot_dir", "./snapshot")
+        self.before = datetime.today() - timedelta(days=1)
+        with self.metrics.stage("load"):
+            # case counts per day from the local snapshot, or the materialized view kept up to date by ingest
+            if counts is None:
+                counts = cv_daily.load_counts(self.db, self.snapshot_dir, self.before)
+            self.snapshot = counts["snapshot"]
+            self.daily = counts["daily"]
+            self.county = counts["county"]
+            self.metrics.count("load", "rows", len(self.daily) + len(self.county))
+
+    # first day number and number of days covered by the counts
+    def day_range(self):
+        days = [cv_rolling.to_day(row["date"]) for row in self.daily]
+        return min(days), max(days) - min(days) + 1
+
+    # new cases per day, statewide first and then one row per county code
+    def case_matrix(self, first_day, days):
+        matrix = np.zeros((len(self.counties) + 1, days), dtype=np.int64)
+        for row in self.daily:
+            matrix[0, cv_rolling.to_day(row["date"]) - first_day] += row["count"]
+        for row in self.county:
+            code = self.counties.code(row["county"])
+            offset = cv_rolling.to_day(row["date"]) - first_day
+            if code != cv_counties.UNKNOWN and 0 <= offset < days:
+                matrix[code + 1, offset] += row["count"]
+        return matrix
+
+    # new cases per day and age band, from the snapshot columns when there is one
+    # otherwise from the dashboard cube ingest keeps up to date, see cv_cube.py. It is only built from florida when missing
+    def age_matrix(self, first_day, days):
+        bands = len(cv_rolling.AGE_BANDS)
+        if self.snapshot is not None:
+            day = np.asarray(self.snapshot.columns["day"], dtype=np.int64)
+            age = np.asarray(self.snapshot.columns["age"], dtype=np.int64)
+            valid = (day >= first_day) & (day < first_day + days)
+            band = np.where(age >= 0, np.minimum(age // 10, bands - 2), bands - 1)[valid]
+            counts = np.bincount(band * days + (day[valid] - first_day), minlength=bands * days)
+            return counts.reshape(bands, days)
+
+        if self.db[cv_cube.COLLECTION].find_one({}, {"_id": 1}) is None:
+            cv_cube.rebuild_cube(self.db)
+        matrix = np.zeros((bands, days), dtype=np.int64)
+        band_rows = {band: row for row, band in enumerate(cv_rolling.AGE_BANDS)}
+        for row in self.db[cv_cube.COLLECTION].find({}, {"_id": 0, "date": 1, "age_band": 1, "cases": 1}):
+            offset = cv_rolling.to_day(row["date"]) - first_day
+            if 0 <= offset < days and row.get("age_band") in band_rows:
+                matrix[band_rows[row["age_band"]], offset] += row["cases"]
+        return matrix
+
+    # statewide new tests per day from other_stats, days without a report count as zero
+    def test_matrix(self, first_day, days):
+        matrix = np.zeros((1, days), dtype=np.int64)
+        query = {"date": {"$gte": cv_rolling.from_day(first_day)}}
+        for row in self.db.other_stats.find(query, {"_id": 0, "date": 1, "new_tests": 1}):
+            offset = cv_rolling.to_day(cv_daily.day_of(row["date"])) - first_day
+            if 0 <= offset < days and isinstance(row.get("new_tests"), int):
+                matrix[0, offset] += row["new_tests"]
+        return matrix
+
+    # bring the cached prefix sums up to date, returns the sums and the first day that has to be published again
+    # the sums are only cached once they were published, see push_stats
+    def update_sums(self):
+        with self.metrics.stage("prefix_sums"):
+            first_day, days = self.day_range()
+            matrices = {
+                "cases": self.case_matrix(first_day, days),
+                "ages": self.age_matrix(first_day, days),
+                "tests": self.test_matrix(first_day, days)
+            }
+            sums = cv_rolling.load_cache(self.snapshot_dir)
+            start = days
+            for name, matrix in matrices.items():
+                if name in sums:
+                    start = min(start, sums[name].update(first_day, matrix))
+                else:
+                    sums[name] = cv_rolling.PrefixSums.from_daily(first_day, matrix)
+                    start = 0
+            self.metrics.count("prefix_sums", "rows", sum(matrix.size for matrix in matrices.values()))
+        # collections that were never written are published in full
+        if self.db.rolling_stats.find_one({}, {"_id": 1}) is None or self.db.rolling_age_stats.find_one({}, {"_id": 1}) is None:
+            start = 0
+        return sums, start
+
+    # documents of rolling_stats for the days from start on, one per county (and the state) and day
+    def county_records(self, sums, ends):
+        cases = sums["cases"]
+        dates = [cv_rolling.from_day(cases.first_day + end) for end in ends]
+        population = np.concatenate([[self.counties.population.sum()], self.counties.population])
+        columns = {
+            "cases": cases.window(ends, 1),
+            "cumulative": cases.total(ends),
+            "doubling_days": cv_rolling.doubling_days(cases, ends, 7)
+        }
+        for days in cv_rolling.WINDOWS:
+            columns[f"avg_{days}"] = cv_rolling.window_mean(cases, ends, days)
+            columns[f"incidence_{days}"] = cv_rolling.per_capita(cases.window(ends, days), population)
+
+        # positivity is only known statewide, tests aren't reported per county
+        tests = sums["tests"]
+        statewide = {"new_tests": tests.window(ends, 1)[0]}
+        for days in cv_rolling.WINDOWS:
+            statewide[f"positivity_{days}"] = cv_rolling.ratio(cases.window(ends, days)[0], tests.window(ends, days)[0])
+
+        records = []
+        for row in range(len(self.counties) + 1):
+            county = cv_daily.STATEWIDE if row == 0 else self.counties.names[row - 1]
+            for index, date in enumerate(dates):
+                record = {
+                    "county": county,
+                    "county_code": row - 1 if row > 0 else None,
+                    "date": date,
+                    "cases": int(columns["cases"][row, index]),
+                    "cumulative": int(columns["cumulative"][row, index])
+                }
+                for days in cv_rolling.WINDOWS:
+                    record[f"avg_{days}"] = cv_rolling.clean(columns[f"avg_{days}"][row, index])
+                    record[f"incidence_{days}"] = cv_rolling.clean(columns[f"incidence_{days}"][row, index])
+                record["doubling_days"] = cv_rolling.clean(columns["doubling_days"][row, index])
+                if row == 0:
+                    record["new_tests"] = int(statewide["new_tests"][index])
+                    for days in cv_rolling.WINDOWS:
+                        record[f"positivity_{days}"] = cv_rolling.clean(statewide[f"positivity_{days}"][index], 4)
+                records.append(record)
+        return records
+
+    # documents of rolling_age_stats for the days from start on, statewide per age band and day
+    def age_records(self, sums, ends):
+        ages = sums["ages"]
+        dates = [cv_rolling.from_day(ages.first_day + end) for end in ends]
+        cases = ages.window(ends, 1)
+        cumulative = ages.total(ends)
+        averages = {days: cv_rolling.window_mean(ages, ends, days) for days in cv_rolling.WINDOWS}
+        records = []
+        for row, band in enumerate(cv_rolling.AGE_BANDS):
+            for index, date in enumerate(dates):
+                record = {
+                    "age_band": band,
+                    "date": date,
+                    "cases": int(cases[row, index]),
+                    "cumulative": int(cumulative[row, index])
+                }
+                for days in cv_rolling.WINDOWS:
+                    record[f"avg_{days}"] = cv_rolling.clean(averages[days][row, index])
+                records.append(record)
+        return records
+
+    # replace the published days from the first changed day on
+    def replace_from(self, collection, since, records):
+        try:
+            self.db[collection].delete_many({"date": {"$gte": since}})
+            if len(records) > 0:
+                self.db[collection].insert_many(records)
+        except Exception as e:
+            print(str(e))
+            return False
+        return True
+
+    def push_stats(self):
+        if len(self.daily) == 0:
+            return
+        sums, start = self.update_sums()
+        ends = np.arange(start, sums["cases"].days)
+        if len(ends) > 0:
+            since = cv_rolling.from_day(sums["cases"].first_day + start)
+            with self.metrics.stage("publish"):
+                records = self.county_records(sums, ends)
+                age_records = self.age_records(sums, ends)
+                self.metrics.count("publish", "rows", len(records) + len(age_records))
+                published = self.replace_from("rolling_stats", since, records) and self.replace_from("rolling_age_stats", since, age_records)
+                self.db.rolling_stats.create_index([("county", 1), ("date", 1)])
+                self.db.rolling_age_stats.create_index([("age_band", 1), ("date", 1)])
+            # the next run compares against the cache, keep the old one so the failed days are published again
+            if not published:
+                return
+        cv_rolling.save_cache(self.snapshot_dir, sums)
+
+# counts can be passed in when they were already loaded by another job, see cv-jobs.py
+def main(config=None, client=None, counts=None):
+    analytics = CoronavirusAnalytics(config, client, counts)
+    analytics.push_stats()
+    analytics.metrics.write()
+
+if __name__ == "__main__":
+    main()
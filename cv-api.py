@@ -1,51 +1,100 @@
 import csv
-import json
 import re
-from pymongo import MongoClient
-from os import path, environ
-from datetime import datetime
+from datetime import datetime, timedelta
 import smtplib
 import requests
 import math
 import time
+import cv_store
+import cv_config
+import cv_daily
+import cv_cube
+import cv_snapshot
+import cv_transform
+import cv_counties
+import cv_metrics
+import cv_httpcache
+import cv_parsers
+import threading
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+# adaptive token bucket shared by all page requests
+class RateLimiter():
+    def __init__(self, rate, burst, min_rate=0.1):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # block until a token is available
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    # server pushed back (429/5xx), halve the rate and drain the bucket
+    def backoff(self, retry_after=None):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+            if retry_after:
+                self.tokens = -retry_after * self.rate
+            self.updated = time.monotonic()
+
+    # request went through, creep back towards the configured rate
+    def success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate * 1.1)
 
 class Coronavirus():
     # constructor
-    def __init__(self):
+    def __init__(self, config=None, client=None):
         # read config, if config.json file is not available then try OS environment vars
-        if path.exists('config.json'):
-            with open('config.json') as config_file:
-                self.config = json.load(config_file)
-        else:
-            self.config = {
-                "mongodb": {
-                    "url": environ.get("DATABASE_URL"),
-                    "database": environ.get("DATABASE_NAME")
-                },
-                "other": {
-                    "dashboard_url": environ.get("DASHBOARD_URL")
-                },
-                "smtp": {
-                    "user": environ.get("SMTP_USER"),
-                    "password": environ.get("SMTP_PASSWORD"),
-                    "email_from": environ.get("EMAIL_FROM"),
-                    "email_to": environ.get("EMAIL_TO"),
-                },
-                "api": {
-                    "url": environ.get("API_URL"),
-                    "daily_url": environ.get("DAILY_STATS_API_URL"),
-                }
-            }
+        self.config = config if config is not None else cv_config.load_config()
+
+        # per stage timings and counters, Mongo commands are counted by the listener
+        self.metrics = cv_metrics.Metrics("cv-api", self.config)
 
         # connect to MongoDB/Atlas
-        self.client = MongoClient(self.config["mongodb"]["url"])
+        self.client = client if client is not None else cv_config.get_client(self.config)
         self.db = self.client.get_database(self.config["mongodb"]["database"])
         self.api_url = self.config["api"]["url"]
         self.api_daily_url = self.config["api"]["daily_url"]
 
+        # concurrent page fetching over a single keep-alive session
+        self.records_per_page = 2000
+        self.concurrency = int(self.config["api"].get("concurrency", 4))
+        self.max_retries = int(self.config["api"].get("max_retries", 5))
+        self.max_in_flight = int(self.config["api"].get("max_in_flight_pages", 2 * self.concurrency))
+        self.limiter = RateLimiter(float(self.config["api"].get("requests_per_second", 2)), self.concurrency)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # conditional requests for the layer metadata, record counts and the daily stats feed
+        self.http_cache = cv_httpcache.HttpCache(self.config["other"].get("http_cache_dir", "./http_cache"))
+        self.layer_url = self.api_url[:-len("/query")] if self.api_url and self.api_url.endswith("/query") else self.api_url
+
+        # county codes and locations, shared with the other jobs of this process
+        self.counties = cv_counties.registry()
+        self.embed_location = cv_counties.embed_location(self.config)
+
     # scrape source data from FLDOH
     def get_case_data(self):
-        locations = self.get_county_locations()
         try:
             request_params = {
                 "where": "1>0",
@@ -53,80 +102,60 @@ class Coronavirus():
                 "f": "pjson"                
             }    
 
-            response = requests.get(self.api_url, params=request_params)
-            data = response.json()
+            with self.metrics.stage("fetch"):
+                data = self.get_json(self.api_url, request_params, cached=True)
+                # the layer's lastEditDate moves whenever a row is added, edited or deleted
+                layer = self.get_json(self.layer_url, {"f": "json"}, cached=True)
+            source_count = data["count"]
  
-            if data["count"] == 0:
+            if source_count == 0:
                 print("No data.")
                 return {
                     "success": False,
                     "message": "No data"
                 }
 
-            print ("Records found: " +  str(data["count"]))
-
-            records_per_page = 2000
-            pages = math.ceil(data["count"] / records_per_page)
-            page_range = range(pages)
-            offset = 0
-            dataset = []
-            
-            for page_no in page_range:
-                request_params = {
-                    "outFields": "Case1, ObjectId, County, Age, Gender, Travel_Related, Origin, EDVisit, Hospitalized, Died, Contact",
-                    "where": "Case_ not like 'NA%'",
-                    "returnCountOnly": "false",
-                    "resultOffset": offset,
-                    "resultRecordCount": records_per_page,
-                    "f": "pjson",
-                    "orderByFields": "Case1"
-                }    
-                print(f"Requesting page {page_no + 1} of {pages}")
-                response = requests.get(self.api_url, params=request_params)
-                offset = (page_no + 1) * records_per_page
-                data = response.json()
-                dataset = dataset + data["features"]
-                
-                # wait loop
-                num_seconds = 2
-                print("Next call in: ", end = '')
-                for countdown in reversed(range(num_seconds + 1)):
-                    if countdown > 0:
-                        print(countdown, end = ' ')
-                        time.sleep(1)
-                    else:
-                        print('Done!')
-
-            # build a collection of cases (dictionaries)
-            row_num = 0
-            cases = []
-            for row in dataset:
-                attributes = row["attributes"]
-                travel_string = attributes["Origin"]
-                travel_list = [ item.strip().title() if ((item is not None) and len(item.strip()) > 2) else item.strip() for item in travel_string.split(";") ] if travel_string != "NA" else None
-                case = {
-                    "case_number": attributes["ObjectId"],
-                    "county": attributes["County"],
-                    "age": int(attributes["Age"]) if (attributes["Age"] != "NA" and attributes["Age"] != None) else None,
-                    "sex": attributes["Gender"],
-                    "travel": attributes["Travel_related"],
-                    "travel_detail": travel_list,
-                    "contact_with_confirmed_case": attributes["Contact"].title() if attributes["Contact"] != "NA" else "No",
-                    "date_added": datetime.fromtimestamp(attributes["Case1"] / 1000.0).replace(hour=0, minute=0, second=0, microsecond=0), 
-                    "deceased": attributes["Died"] if attributes["Died"] != "NA" else "No",
-                    "location": locations.get(attributes["County"], None),
-                    "hospitalized": attributes["Hospitalized"].title() if (attributes["Hospitalized"] is not None and attributes["Hospitalized"] != "NA") else None,
-                    "ed_visit": attributes["EDvisit"].title() if ((attributes["EDvisit"] is not None) and attributes["EDvisit"] != "NA") else None,
+            print ("Records found: " +  str(source_count))
+
+            # only ask for cases past the high-water mark unless a full refresh is due
+            with self.metrics.stage("fetch"):
+                state = self.db.ingest_state.find_one({"_id": "florida"})
+            full_refresh = self.full_refresh_due(state, source_count)
+            fingerprint = self.source_fingerprint(layer, source_count)
+            if not full_refresh and state.get("fingerprint") == fingerprint:
+                print("Source unchanged since the last run.")
+                return {
+                    "success": True,
+                    "message": "No changes",
+                    "new_cases": 0
                 }
-                cases.append(case)
+            where = "Case_ not like 'NA%'"
+            count = source_count
+            if not full_refresh:
+                where = f"{where} AND ObjectId > {state['max_object_id']}"
+                with self.metrics.stage("fetch"):
+                    data = self.get_json(self.api_url, {"where": where, "returnCountOnly": "true", "f": "pjson"})
+                count = data["count"]
+                print(f"Incremental refresh, {count} records past ObjectId {state['max_object_id']}")
+            else:
+                print("Full refresh")
 
-            # store to database
-            store_result = self.store_data(cases, "florida")
-            
+            # fetch, transform and store one page at a time
+            high_water = {"max_object_id": 0, "max_case1": 0}
+            pages = (self.transform_page(features, high_water) for features in self.metrics.pages("fetch", self.fetch_pages(where, count)))
+            with self.metrics.stage("store"):
+                store_result = self.store_pages(pages, "florida", partial=not full_refresh)
+
+            if not store_result["success"]:
+                return store_result
+            self.metrics.count("store", "rows", store_result["inserted"] + store_result["updated"] + store_result["deleted"])
+            with self.metrics.stage("store"):
+                self.update_watermark(state, high_water, source_count, full_refresh, fingerprint)
+            with self.metrics.stage("snapshot"):
+                self.write_snapshot(store_result)
 
         except Exception as e:
             print(str(e))
-            print(attributes)
             return {
                 "success": False,
                 "message": str(e)
@@ -138,35 +167,135 @@ class Coronavirus():
             "new_cases": store_result['new_records']
         }
     
+    # yield pages of features in offset order, keeping at most max_in_flight pages in memory
+    def fetch_pages(self, where, count):
+        pages = math.ceil(count / self.records_per_page)
+        offsets = iter(range(0, pages * self.records_per_page, self.records_per_page))
+        print(f"Requesting {pages} pages, {self.concurrency} at a time")
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            in_flight = deque()
+            for offset in itertools.islice(offsets, self.max_in_flight):
+                in_flight.append(executor.submit(self.get_page, offset, where))
+            while len(in_flight) > 0:
+                features = in_flight.popleft().result()
+                offset = next(offsets, None)
+                if offset is not None:
+                    in_flight.append(executor.submit(self.get_page, offset, where))
+                yield features
+
+    # build a page of cases (dictionaries) from a page of features
+    def transform_page(self, features, high_water):
+        max_object_id, max_case1 = cv_transform.high_water_mark(features)
+        high_water["max_object_id"] = max(high_water["max_object_id"], max_object_id)
+        high_water["max_case1"] = max(high_water["max_case1"], max_case1)
+        with self.metrics.stage("transform", rows=len(features)):
+            return cv_transform.transform_features(features, self.counties, self.embed_location)
+
+    # decide whether the stored high-water mark can be trusted for this run
+    def full_refresh_due(self, state, source_count):
+        if not self.config["api"].get("incremental", True) or state is None:
+            return True
+        # rows were removed or renumbered upstream
+        if source_count < state["source_count"]:
+            return True
+        full_refresh_days = int(self.config["api"].get("full_refresh_days", 7))
+        return datetime.now() - state["last_full_refresh"] >= timedelta(days=full_refresh_days)
+
+    # record the last ingested ObjectId/Case1 so the next run only asks for newer rows
+    def update_watermark(self, state, high_water, source_count, full_refresh, fingerprint=None):
+        incremental = state is not None and not full_refresh
+        watermark = {
+            "max_object_id": max(high_water["max_object_id"], state["max_object_id"] if incremental else 0),
+            "max_case1": max(high_water["max_case1"], state["max_case1"] if incremental else 0),
+            "source_count": source_count,
+            "fingerprint": fingerprint,
+            "last_full_refresh": state["last_full_refresh"] if incremental else datetime.now(),
+            "updated": datetime.now()
+        }
+        self.db.ingest_state.update_one({"_id": "florida"}, {"$set": watermark}, upsert=True)
+
+    # identifies the state of the source table, falls back to hashing the layer metadata
+    def source_fingerprint(self, layer, source_count):
+        last_edit = layer.get("editingInfo", {}).get("lastEditDate")
+        return f"{last_edit if last_edit is not None else cv_store.hash_record(layer)}:{source_count}"
+
+    # request a single page of case line data starting at offset
+    # ObjectId breaks the ties of Case1, pages fetched concurrently only tile the result when the order is total
+    def get_page(self, offset, where):
+        request_params = {
+            "outFields": "Case1, ObjectId, County, Age, Gender, Travel_Related, Origin, EDVisit, Hospitalized, Died, Contact",
+            "where": where,
+            "returnCountOnly": "false",
+            "resultOffset": offset,
+            "resultRecordCount": self.records_per_page,
+            "f": "pjson",
+            "orderByFields": "Case1, ObjectId"
+        }
+        data = self.get_json(self.api_url, request_params)
+        print(f"Received page {offset // self.records_per_page + 1}")
+        return data["features"]
+
+    # rate limited GET, backs off and retries on 429/5xx responses, cached requests go through the HTTP cache
+    def get_json(self, url, params, cached=False):
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            if cached:
+                response = self.http_cache.get(self.session, url, params)
+                self.metrics.count("fetch", "bytes", response.downloaded)
+            else:
+                response = self.session.get(url, params=params)
+                self.metrics.count("fetch", "bytes", len(response.content))
+            if response.status_code == 429 or response.status_code >= 500:
+                retry_after = response.headers.get("Retry-After")
+                self.limiter.backoff(float(retry_after) if retry_after and retry_after.isdigit() else None)
+                print(f"Server returned {response.status_code}, backing off (attempt {attempt + 1})")
+                self.metrics.count("fetch", "retries")
+                continue
+            response.raise_for_status()
+            data = response.json()
+            # ArcGIS reports throttling as a 200 with an error body
+            if "error" in data and data["error"].get("code") in (429, 500, 503, 504):
+                self.limiter.backoff()
+                print(f"Server returned error {data['error'].get('code')}, backing off (attempt {attempt + 1})")
+                self.metrics.count("fetch", "retries")
+                continue
+            if "error" in data:
+                raise Exception(data["error"].get("message", str(data["error"])))
+            self.limiter.success()
+            return data
+
+        raise Exception(f"Giving up on {url} after {self.max_retries} retries")
+
     def get_other_data(self):
         try:
             request_params = {}
 
-            response = requests.get(self.api_daily_url, params=request_params)
-            data = response.json()
-            florida = list(filter(lambda item: item["state"] == "FL", iter(data)))
-
-            # build a collection of records (dictionaries)
-            row_num = 0
-            stats = [] 
-            for item in florida:
-                prev_deaths = item["death"] - item["deathIncrease"] if ("death" in item and item["death"] != None and item["deathIncrease"] != None) else 0
-                prev_hospitalized = item["hospitalized"] - item["hospitalizedIncrease"] if ("hospitalized" in item and item["hospitalized"] != None and "hospitalizedIncrease" in item and item["hospitalizedIncrease"] != None) else 0
-                record = {
-                    "date": datetime.strptime(str(item["date"]), '%Y%m%d'),
-                    "tests": item["totalTestResults"] if "totalTestResults" in item else 0,
-                    "new_tests": item["totalTestResultsIncrease"],
-                    "deaths": item["death"] if "death" in item else 0,
-                    "new_deaths": item["deathIncrease"],
-                    "deaths_growth": (item["death"] / prev_deaths) if prev_deaths > 0 else 0,
-                    "hospitalized": item["hospitalized"] if "hospitalized" in item else 0,
-                    "new_hospitalized": item["hospitalizedIncrease"],
-                    "hospitalized_growth": (item["hospitalized"] / prev_hospitalized) if prev_hospitalized > 0 else 0
-                }
-                stats.append(record)
+            # only days from the latest one already stored are kept, it's often revised the next day
+            latest = self.db.other_stats.find_one({}, {"date": 1}, sort=[("date", -1)])
+            since = latest["date"] if latest is not None else None
+            state = self.db.ingest_state.find_one({"_id": "other_stats"})
+
+            # parse the all-states feed as it downloads, keeping only the configured state
+            with self.metrics.stage("other_fetch"):
+                with self.http_cache.stream(self.session, self.api_daily_url, request_params) as response:
+                    response.raise_for_status()
+                    # nothing to do if the feed is byte for byte what was stored last time
+                    if response.from_cache and state is not None and state.get("content_hash") == response.content_hash:
+                        print("Daily stats unchanged since the last run.")
+                        return {
+                            "success": True,
+                            "message": "0 new records added"
+                        }
+                    items = list(cv_parsers.iter_daily_items(response.raw, {self.config["api"].get("state", "FL")}))
+                self.metrics.count("other_fetch", "bytes", response.downloaded)
+            stats = cv_parsers.daily_records(items, since)
 
             # store to database
-            store_result = self.store_data(stats, "other_stats")
+            with self.metrics.stage("other_store", rows=len(stats)):
+                store_result = self.store_data(stats, "other_stats", partial=True)
+                if store_result["success"]:
+                    self.db.ingest_state.update_one({"_id": "other_stats"}, {"$set": {"content_hash": response.content_hash, "updated": datetime.now()}}, upsert=True)
 
         except Exception as e:
             print(str(e))
@@ -180,32 +309,30 @@ class Coronavirus():
             "message": f"{store_result['new_records']} new records added"
         }
 
-    # store records to Atlas/MongoDB instance
-    def store_data(self, records, collection):     
-        current_count = self.db.get_collection(collection).estimated_document_count()
-        new_records = len(records) - current_count
-        # remove all records
-        self.db.get_collection(collection).delete_many({})
-        
-        print(f"Adding {new_records} new records to collection {collection}.")
+    # store records to Atlas/MongoDB instance, only changed documents are written
+    def store_data(self, records, collection, partial=False):
+        return self.store_pages([records], collection, partial)
 
-        try:
-            if len(records) > 0:
-                print("Adding records to database.")
-                self.db.get_collection(collection).insert_many(records)    
-        except Exception as e:
-            print(str(e))
-            return {
-                "success": False,
-                "message": str(e)
-            }
-        
-        return {
-            "success": True,
-            "message": "",
-            "new_records": new_records
-        }
+    # store an iterable of record pages, writing each page as it arrives
+    def store_pages(self, pages, collection, partial=False):
+        key = "case_number" if collection == "florida" else "date"
+        # case changes also roll into the materialized daily counts
+        tracker = cv_store.Trackers(cv_daily.DailyCountTracker(), cv_cube.CubeTracker()) if collection == "florida" else None
+        result = cv_store.store_pages(self.db, pages, collection, key, mode=self.config["mongodb"].get("sync", "diff"), partial=partial, tracker=tracker)
+        if result["success"]:
+            result["new_records"] = result["inserted"]
+        return result
     
+    # refresh the local columnar snapshot read by the stats jobs
+    def write_snapshot(self, store_result):
+        snapshot_dir = self.config["other"].get("snapshot_dir", "./snapshot")
+        changed = store_result["inserted"] + store_result["updated"] + store_result["deleted"] > 0
+        if changed or cv_snapshot.read_manifest(snapshot_dir) is None:
+            try:
+                cv_snapshot.write_snapshot(self.db, snapshot_dir)
+            except Exception as e:
+                print(str(e))
+
     # sends email notification with the specified message and analytics dashboard URL
     def send_mail(self, message):
         server = smtplib.SMTP('smtp.gmail.com', 587)
@@ -230,18 +357,16 @@ class Coronavirus():
         print('Sent email notification')
         server.quit()
 
-    def get_county_locations(self):
-        counties_file = open('./datasets/json/florida_counties.json')
-        counties = json.load(counties_file)
-        locations_hash = {}
-        for county in counties:
-            locations_hash[county["county"]] = county["location"]
+# ingest new cases, refresh the daily stats and send the notification, see also cv-jobs.py
+def main(config=None, client=None):
+    bot = Coronavirus(config, client)
+    case_result = bot.get_case_data()
 
-        return locations_hash
-        
-bot = Coronavirus()
-case_result = bot.get_case_data()
+    if case_result["success"] and case_result["new_cases"] > 0:
+        other_result = bot.get_other_data()
+        bot.send_mail(case_result['message'])
+    bot.metrics.write(case_result["success"])
+    return case_result
 
-if case_result["success"] and case_result["new_cases"] > 0:
-    other_result = bot.get_other_data()
-    bot.send_mail(case_result['message'])
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,108 +1,136 @@
-from pymongo import MongoClient
-from os import path, environ
 from datetime import datetime, date, timedelta
-import json
 import pandas as pd
+import cv_query
+import cv_config
+import cv_daily
+import cv_metrics
+import cv_store
+import cv_counties
 
 class CoronavirusStats():
     # constructor
-    def __init__(self):
+    def __init__(self, config=None, client=None, counts=None):
         # read config, if config.json file is not available then try OS environment vars
-        if path.exists('config.json'):
-            with open('config.json') as config_file:
-                self.config = json.load(config_file)
-        else:
-            self.config = {
-                "mongodb": {
-                    "url": environ.get("DATABASE_URL"),
-                    "database": environ.get("DATABASE_NAME")
-                },
-                "other": {
-                    "dashboard_url": environ.get("DASHBOARD_URL")
-                },
-                "smtp": {
-                    "user": environ.get("SMTP_USER"),
-                    "password": environ.get("SMTP_PASSWORD"),
-                    "email_from": environ.get("EMAIL_FROM"),
-                    "email_to": environ.get("EMAIL_TO"),
-                }
-            }
+        self.config = config if config is not None else cv_config.load_config()
+
+        # per stage timings and counters, Mongo commands are counted by the listener
+        self.metrics = cv_metrics.Metrics("cv-county-stats", self.config)
 
         # connect to MongoDB/Atlas
-        self.client = MongoClient(self.config["mongodb"]["url"])
+        self.client = client if client is not None else cv_config.get_client(self.config)
         self.db = self.client.get_database(self.config["mongodb"]["database"])
+        # counties are handled by code, names are joined back in when documents are built
+        self.counties = cv_counties.registry()
         today = datetime.today() - timedelta(days=1)
-        self.data = self.read_mongo("florida", {"date_added": {"$lt": today}})
+        # case counts per county and day from the local snapshot, or the materialized view kept up to date by ingest
+        with self.metrics.stage("load"):
+            if counts is None:
+                counts = cv_daily.load_counts(self.db, self.config["other"].get("snapshot_dir", "./snapshot"), today)
+            self.snapshot = counts["snapshot"]
+            county_counts = counts["county"]
+            self.data = pd.DataFrame({
+                "county_code": [self.counties.intern(row["county"]) for row in county_counts],
+                "date_added": [row["date"] for row in county_counts],
+                "count": [row["count"] for row in county_counts]
+            })
+            self.metrics.count("load", "rows", len(county_counts))
 
     # Convert MongoDB cursor to Pandas dataframe
-    def read_mongo(self, collection, query={}, no_id=True):
+    def read_mongo(self, collection, query={}, projection=None, no_id=True):
         """ Read from Mongo and Store into DataFrame """
-
-        # Make a query to the specific DB and Collection
-        cursor = self.db[collection].find(query)
-
-        # Expand the cursor and construct the DataFrame
-        df =  pd.DataFrame(list(cursor))
-
-        # Delete the _id
-        if no_id:
-            del df['_id']
-
-        return df
-
-    # get case count cumulative sum by date
-    def cum_sum_by_county(self, counties):
-        count_by_date_county = self.data.set_index(['county', 'date_added']).groupby(level=[0,1]).case_number.count()
-        data = []
-        county_info = self.get_county_info()
-        for county in counties:
-            population = county_info[county]["population"]
-            cum_sum = count_by_date_county[county].cumsum().to_dict()
-            for date, count in cum_sum.items():
-                data.append({
-                    "county": county,
-                    "date": date,
-                    "count": count,
-                    "normalized_count": round(count / (population / 1000), 2)
-                })
-        
-        return data
-
-    def get_top_five_counties(self):
-        largest_five = self.data.groupby(['county'])['case_number'].count().nlargest(5)
-        return largest_five.to_dict().keys()
-
-    def get_county_info(self):
-        counties_file = open('./datasets/json/florida_counties.json')
-        counties = json.load(counties_file)
-        counties_dict = {}
-        for county in counties:
-            counties_dict[county["county"]] = {
-                "name": county["county"],
-                "location": county["location"],
-                "population": county["population"]
-            }
-
-        return counties_dict
+        return cv_query.read_mongo(self.db, collection, query, projection, no_id)
+
+    # cumulative counts as a county codes x dates matrix, every registered county gets a row
+    def cum_sum_matrix(self):
+        counts = self.data.pivot_table(index="county_code", columns="date_added", values="count", aggfunc="sum", fill_value=0)
+        codes = sorted(set(range(len(self.counties))) | set(counts.index))
+        return counts.reindex(codes, fill_value=0).cumsum(axis=1)
+
+    # cumulative counts per 1,000 residents, NaN for counties without a population
+    def normalize(self, cum_sum):
+        population = self.get_population(cum_sum.index)
+        return cum_sum.div(population / 1000, axis=0).round(2)
+
+    # get case count cumulative sum by date for all counties
+    def cum_sum_all_counties(self):
+        with self.metrics.stage("cum_sum", rows=len(self.data)):
+            cum_sum = self.cum_sum_matrix()
+            normalized = self.normalize(cum_sum)
+            frame = pd.DataFrame({
+                "count": cum_sum.stack(),
+                "normalized_count": normalized.stack()
+            }).reset_index()
+            frame.columns = ["county_code", "date", "count", "normalized_count"]
+            frame["normalized_count"] = frame["normalized_count"].astype(object).where(frame["normalized_count"].notna(), None)
+            return frame
+
+    # get case count cumulative sum by date for the given county codes
+    def cum_sum_by_county(self, codes, all_counties=None):
+        if all_counties is None:
+            all_counties = self.cum_sum_all_counties()
+        with self.metrics.stage("cum_sum_by_county"):
+            rows = all_counties[all_counties["county_code"].isin(list(codes))]
+            return self.to_records(rows)
+
+    def get_top_counties(self, count, all_counties=None):
+        if all_counties is None:
+            all_counties = self.cum_sum_all_counties()
+        last_date = all_counties["date"].max()
+        totals = all_counties[all_counties["date"] == last_date].set_index("county_code")["count"]
+        return totals.nlargest(count).to_dict().keys()
+
+    def get_top_five_counties(self, all_counties=None):
+        return self.get_top_counties(5, all_counties)
+
+    # DataFrame rows -> documents with plain python values, county names are joined in here
+    def to_records(self, rows):
+        names = {code: self.counties.name(code) for code in set(rows["county_code"])}
+        return [{
+            "county": names[code],
+            "county_code": int(self.counties.registered(code)),
+            "date": date.to_pydatetime(),
+            "count": int(count),
+            "normalized_count": normalized_count
+        } for code, date, count, normalized_count in zip(rows["county_code"], rows["date"], rows["count"], rows["normalized_count"])]
+
+    # population per county code as a Series
+    def get_population(self, codes):
+        return pd.Series(self.counties.population_of(codes), index=codes)
+
+    # population and location of every county, charts join them to cases and stats by county_code
+    def push_counties(self):
+        with self.metrics.stage("push_counties", rows=len(self.counties)):
+            result = cv_store.store_data(self.db, self.counties.documents(), "counties", "county_code")
+            if not result["success"]:
+                print(result["message"])
+
+    # all counties collection, swapped in atomically through a staging collection
+    def push_all_counties(self, all_counties):
+        with self.metrics.stage("push_all_counties", rows=len(all_counties)):
+            result = cv_store.rebuild_pages(self.db, [self.to_records(all_counties)], "all_counties")
+            if result["success"]:
+                self.db.all_counties.create_index([("county", 1), ("date", 1)])
 
     def push_stats(self, data):
         
-        # rebuild data
-        self.db.top_five_counties.delete_many({})
-
-        try:
-            self.db.top_five_counties.insert_many(data)    
-        except Exception as e:
-            print(str(e))
-
-stats = CoronavirusStats()
-data = stats.cum_sum_by_county(stats.get_top_five_counties())
-stats.push_stats(data)
-
-
-
-
-
-
-
-
+        with self.metrics.stage("push_stats", rows=len(data)):
+            # rebuild data
+            self.db.top_five_counties.delete_many({})
+
+            try:
+                self.db.top_five_counties.insert_many(data)    
+            except Exception as e:
+                print(str(e))
+
+# counts can be passed in when they were already loaded by another job, see cv-jobs.py
+def main(config=None, client=None, counts=None):
+    stats = CoronavirusStats(config, client, counts)
+    stats.push_counties()
+    all_counties = stats.cum_sum_all_counties()
+    stats.push_all_counties(all_counties)
+    data = stats.cum_sum_by_county(stats.get_top_five_counties(all_counties), all_counties)
+    stats.push_stats(data)
+    stats.metrics.write()
+
+if __name__ == "__main__":
+    main()
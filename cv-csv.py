@@ -1,68 +1,50 @@
 import csv
-import json
-import re
-from pymongo import MongoClient
-from os import path, environ
+import os
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import smtplib
+import cv_store
+import cv_config
+import cv_daily
+import cv_cube
+import cv_snapshot
+import cv_parsers
+import cv_counties
+import cv_metrics
 
 class Coronavirus():
     # constructor
-    def __init__(self):
+    def __init__(self, config=None, client=None):
         # read config, if config.json file is not available then try OS environment vars
-        if path.exists('config.json'):
-            with open('config.json') as config_file:
-                self.config = json.load(config_file)
-        else:
-            self.config = {
-                "mongodb": {
-                    "url": environ.get("DATABASE_URL"),
-                    "database": environ.get("DATABASE_NAME")
-                },
-                "other": {
-                    "dashboard_url": environ.get("DASHBOARD_URL")
-                },
-                "smtp": {
-                    "user": environ.get("SMTP_USER"),
-                    "password": environ.get("SMTP_PASSWORD"),
-                    "email_from": environ.get("EMAIL_FROM"),
-                    "email_to": environ.get("EMAIL_TO"),
-                }
-            }
+        self.config = config if config is not None else cv_config.load_config()
+
+        # per stage timings and counters, Mongo commands are counted by the listener
+        self.metrics = cv_metrics.Metrics("cv-csv", self.config)
 
         # connect to MongoDB/Atlas
-        self.client = MongoClient(self.config["mongodb"]["url"])
+        self.client = client if client is not None else cv_config.get_client(self.config)
         self.db = self.client.get_database(self.config["mongodb"]["database"])
+        self.embed_location = cv_counties.embed_location(self.config)
 
-    # scrape source data from FLDOH
-    def get_case_data(self, csv_file):
-        locations = self.get_county_locations()
+    # load case data from a FLDOH report CSV or a mongoexport CSV of the florida collection
+    def get_case_data(self, csv_file, workers=None, chunk_bytes=8 * 1024 * 1024):
         try:
-            file = open(csv_file)
-            csv_reader = csv.reader(file, delimiter=',')
-            # build a collection of cases (dictionaries)
-            row_num = 0
-            cases = []
-            for row in csv_reader:
-
-                case = {
-                    "case_number": int(re.sub("[^0-9]", "", row[0])),
-                    "county": row[1],
-                    "age": int(re.sub("[^0-9]", "", row[2])) if row[2].strip() else 'Unknown',
-                    "sex": row[3],
-                    "travel": row[4],
-                    "travel_detail": [ item.strip().title() if len(item.strip()) > 2 else item.strip() for item in row[5].split(";") ] if row[5] else None,
-                    "contact_with_confirmed_case": row[6] if row[6] else 'Unknown',
-                    "jurisdiction": row[7],
-                    "date_added": datetime.strptime(row[8], '%m/%d/%y'),
-                    "deceased": row[9],
-                    "location": locations.get(row[1], None)
-                }
-                cases.append(case)
-
-            # store to database
-            store_result = self.store_data(cases, "florida")
-            self.client.close()
+            layout = cv_parsers.detect_layout(csv_file)
+            ranges = cv_parsers.chunk_ranges(csv_file, chunk_bytes, skip_header=(layout == cv_parsers.EXPORT))
+            print(f"Reading {csv_file} ({layout} layout) in {len(ranges)} chunks.")
+
+            # parse chunks in worker processes and store each one as it comes back
+            self.metrics.count("parse", "bytes", os.path.getsize(csv_file))
+            cases = self.metrics.pages("parse", self.parse_chunks(csv_file, layout, ranges, workers or os.cpu_count()))
+            with self.metrics.stage("store"):
+                store_result = self.store_pages(cases, "florida")
+            if not store_result["success"]:
+                return store_result
+            self.metrics.count("store", "rows", store_result["inserted"] + store_result["updated"] + store_result["deleted"])
+            with self.metrics.stage("snapshot"):
+                self.write_snapshot(store_result)
 
         except Exception as e:
             print(str(e))
@@ -95,8 +77,8 @@ class Coronavirus():
                 stats.append(record)
 
             # store to database
-            store_result = self.store_data(stats, "other_stats")
-            self.client.close()
+            with self.metrics.stage("other_store", rows=len(stats)):
+                store_result = self.store_data(stats, "other_stats")
 
         except Exception as e:
             print(str(e))
@@ -110,32 +92,44 @@ class Coronavirus():
             "message": f"{store_result['new_cases']} new cases added"
         }
 
-    # store case data to Atlas/MongoDB instance
-    def store_data(self, records, collection):        
-        current_count = self.db.get_collection(collection).estimated_document_count()
-        new_records = len(records) - current_count
-        # remove all cases
-        self.db.get_collection(collection).delete_many({})
-        
-        print(f"Adding {new_records} new records to collection {collection}.")
-
-        try:
-            if len(records) > 0:
-                print("Adding records to database.")
-                self.db.get_collection(collection).insert_many(records)    
-        except Exception as e:
-            print(str(e))
-            return {
-                "success": False,
-                "message": str(e)
-            }
-        
-        return {
-            "success": True,
-            "message": "",
-            "new_cases": new_records
-        }
+    # yield parsed chunks in file order, keeping at most two chunks per worker in flight
+    def parse_chunks(self, csv_file, layout, ranges, workers):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = iter(ranges)
+            in_flight = deque()
+            for start, end in itertools.islice(pending, 2 * workers):
+                in_flight.append(executor.submit(cv_parsers.parse_chunk, csv_file, layout, start, end, self.embed_location))
+            while len(in_flight) > 0:
+                cases = in_flight.popleft().result()
+                next_range = next(pending, None)
+                if next_range is not None:
+                    in_flight.append(executor.submit(cv_parsers.parse_chunk, csv_file, layout, *next_range, self.embed_location))
+                yield cases
+
+    # store case data to Atlas/MongoDB instance, only changed documents are written
+    def store_data(self, records, collection):
+        return self.store_pages([records], collection)
+
+    # store an iterable of record pages, writing each page as it arrives
+    def store_pages(self, pages, collection):
+        key = "case_number" if collection == "florida" else "date"
+        # case changes also roll into the materialized daily counts
+        tracker = cv_store.Trackers(cv_daily.DailyCountTracker(), cv_cube.CubeTracker()) if collection == "florida" else None
+        result = cv_store.store_pages(self.db, pages, collection, key, mode=self.config["mongodb"].get("sync", "diff"), tracker=tracker)
+        if result["success"]:
+            result["new_cases"] = result["inserted"]
+        return result
     
+    # refresh the local columnar snapshot read by the stats jobs
+    def write_snapshot(self, store_result):
+        snapshot_dir = self.config["other"].get("snapshot_dir", "./snapshot")
+        changed = store_result["inserted"] + store_result["updated"] + store_result["deleted"] > 0
+        if changed or cv_snapshot.read_manifest(snapshot_dir) is None:
+            try:
+                cv_snapshot.write_snapshot(self.db, snapshot_dir)
+            except Exception as e:
+                print(str(e))
+
     # sends email notification with the specified message and analytics dashboard URL
     def send_mail(self, message):
         server = smtplib.SMTP('smtp.gmail.com', 587)
@@ -159,18 +153,12 @@ class Coronavirus():
 
         print('Sent email notification')
         server.quit()
-
-    def get_county_locations(self):
-        counties_file = open('./datasets/json/florida_counties.json')
-        counties = json.load(counties_file)
-        locations_hash = {}
-        for county in counties:
-            locations_hash[county["county"]] = county["location"]
-
-        return locations_hash
         
-bot = Coronavirus()
-case_result = bot.get_case_data("./datasets/csv/cases.csv")
-other_result = bot.get_other_data("./datasets/csv/other_stats.csv")
-
-bot.send_mail(case_result['message'])
+# worker processes re-import this module on platforms without fork
+if __name__ == "__main__":
+    bot = Coronavirus()
+    case_result = bot.get_case_data("./datasets/csv/cases.csv")
+    other_result = bot.get_other_data("./datasets/csv/other_stats.csv")
+
+    bot.send_mail(case_result['message'])
+    bot.metrics.write(case_result["success"] and other_result["success"])
@@ -0,0 +1,74 @@
+import argparse
+import importlib.util
+import sys
+from os import path
+from datetime import datetime, timedelta
+import cv_config
+import cv_daily
+
+# run the nightly jobs in one process with a single MongoClient
+#   ingest       - cv-api.py (or cv.py with --source html)
+#   stats        - cv-stats.py
+#   county-stats - cv-county-stats.py
+#   analytics    - cv-analytics.py
+#   all          - ingest, then the stats and analytics jobs from one load of the case counts
+#   indexes      - build the indexes in cv_indexes.py and fail when a hot query still scans its collection
+# job scripts are only imported by the subcommands that run them, so pandas and selenium stay out of the others
+JOBS = {
+    "api": "cv-api.py",
+    "html": "cv.py",
+    "stats": "cv-stats.py",
+    "county-stats": "cv-county-stats.py",
+    "analytics": "cv-analytics.py"
+}
+
+def load_job(name):
+    file_name = path.join(path.dirname(path.abspath(__file__)), JOBS[name])
+    spec = importlib.util.spec_from_file_location(JOBS[name][:-3].replace("-", "_"), file_name)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def ingest(config, client, source):
+    result = load_job(source).main(config, client)
+    return result["success"]
+
+# the stats jobs read the same counts, load them once
+def stats(config, client, jobs):
+    db = client.get_database(config["mongodb"]["database"])
+    today = datetime.today() - timedelta(days=1)
+    counts = cv_daily.load_counts(db, config["other"].get("snapshot_dir", "./snapshot"), today)
+    for name in jobs:
+        load_job(name).main(config, client, counts)
+    return True
+
+def indexes(config, client):
+    import cv_indexes
+    return cv_indexes.main(config, client)["success"]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the COVID-19-FL jobs in a single process.")
+    parser.add_argument("command", choices=["ingest", "stats", "county-stats", "analytics", "indexes", "all"])
+    parser.add_argument("--source", choices=["api", "html"], default="api", help="ingest from the ArcGIS API (cv-api.py) or the FLDOH page (cv.py)")
+    args = parser.parse_args()
+
+    config = cv_config.load_config()
+    client = cv_config.get_client(config)
+    success = True
+    try:
+        if args.command in ("ingest", "all"):
+            success = ingest(config, client, args.source) and success
+        if args.command == "stats":
+            success = stats(config, client, ["stats"]) and success
+        elif args.command == "county-stats":
+            success = stats(config, client, ["county-stats"]) and success
+        elif args.command == "analytics":
+            success = stats(config, client, ["analytics"]) and success
+        elif args.command == "indexes":
+            success = indexes(config, client) and success
+        elif args.command == "all":
+            success = stats(config, client, ["stats", "county-stats", "analytics"]) and success
+    finally:
+        cv_config.close_clients()
+
+    sys.exit(0 if success else 1)
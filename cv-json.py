@@ -0,0 +1,141 @@
+import argparse
+import json
+from pymongo.errors import BulkWriteError
+from bson import ObjectId, Decimal128
+from datetime import datetime, timezone
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import cv_daily
+import cv_cube
+import cv_snapshot
+import cv_config
+
+# orjson is optional, it decodes NDJSON lines several times faster than the json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# extended JSON date: {"$numberLong": "..."}, epoch milliseconds or an ISO-8601 string
+def parse_date(value):
+    if isinstance(value, dict):
+        value = int(value["$numberLong"])
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value / 1000.0, tz=timezone.utc).replace(tzinfo=None)
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).astimezone(timezone.utc).replace(tzinfo=None)
+
+# single-key wrappers written by mongoexport
+WRAPPERS = {
+    "$oid": ObjectId,
+    "$numberInt": int,
+    "$numberLong": int,
+    "$numberDouble": float,
+    "$numberDecimal": Decimal128,
+    "$date": parse_date,
+}
+
+# unwrap one object, children are already unwrapped when used as a json object_hook
+def unwrap_object(obj):
+    if len(obj) == 1:
+        for key, value in obj.items():
+            if key in WRAPPERS:
+                return WRAPPERS[key](value)
+    return obj
+
+# unwrap a whole decoded document (for decoders without an object hook)
+def unwrap(value):
+    if isinstance(value, dict):
+        return unwrap_object({key: unwrap(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return [unwrap(item) for item in value]
+    return value
+
+def decode_line(line):
+    if orjson is not None:
+        return unwrap(orjson.loads(line))
+    return json.loads(line, object_hook=unwrap_object)
+
+# yield batches of documents, reading the export one line at a time
+def read_batches(file_name, batch_size):
+    batch = []
+    with open(file_name, "rb") as export_file:
+        for line in export_file:
+            line = line.strip()
+            if not line:
+                continue
+            batch.append(decode_line(line))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if len(batch) > 0:
+        yield batch
+
+class CoronavirusLoader():
+    # constructor
+    def __init__(self, config=None, client=None):
+        # read config, if config.json file is not available then try OS environment vars
+        self.config = config if config is not None else cv_config.load_config()
+
+        # connect to MongoDB/Atlas
+        self.client = client if client is not None else cv_config.get_client(self.config)
+        self.db = self.client.get_database(self.config["mongodb"]["database"])
+
+    # insert one batch, documents already present (same _id) are skipped
+    def insert_batch(self, collection, batch):
+        try:
+            self.db[collection].insert_many(batch, ordered=False)
+            return len(batch), 0
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            duplicates = len([error for error in errors if error.get("code") == 11000])
+            if duplicates < len(errors):
+                raise
+            return e.details.get("nInserted", 0), duplicates
+
+    # stream the export files into a collection, with up to workers batches in flight
+    def load(self, files, collection, workers=4, batch_size=1000, drop=False):
+        if drop:
+            print(f"Dropping collection {collection}.")
+            self.db[collection].drop()
+
+        inserted = skipped = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            in_flight = deque()
+            for file_name in files:
+                print(f"Loading {file_name} into {collection}.")
+                for batch in read_batches(file_name, batch_size):
+                    # bound memory to the batches being written
+                    if len(in_flight) >= 2 * workers:
+                        batch_inserted, batch_skipped = in_flight.popleft().result()
+                        inserted += batch_inserted
+                        skipped += batch_skipped
+                    in_flight.append(executor.submit(self.insert_batch, collection, batch))
+            while len(in_flight) > 0:
+                batch_inserted, batch_skipped = in_flight.popleft().result()
+                inserted += batch_inserted
+                skipped += batch_skipped
+
+        print(f"Inserted {inserted} documents, skipped {skipped} already present.")
+        if collection == "florida":
+            cv_daily.rebuild_daily_counts(self.db)
+            cv_cube.rebuild_cube(self.db)
+            cv_snapshot.invalidate(self.db)
+
+        return {
+            "success": True,
+            "message": f"{inserted} documents loaded",
+            "inserted": inserted,
+            "skipped": skipped
+        }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load mongoexport extended JSON (NDJSON) files into MongoDB.")
+    parser.add_argument("files", nargs="+", help="export files, e.g. datasets/json/032820202114.json")
+    parser.add_argument("--collection", default="florida")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--drop", action="store_true", help="drop the collection before loading")
+    args = parser.parse_args()
+
+    loader = CoronavirusLoader()
+    loader.load(args.files, args.collection, args.workers, args.batch_size, args.drop)
@@ -0,0 +1,156 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+from os import path
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import cv_store
+import cv_config
+import cv_daily
+import cv_cube
+import cv_snapshot
+import cv_parsers
+import cv_counties
+
+class CoronavirusReports():
+    # constructor
+    def __init__(self, config=None, client=None):
+        # read config, if config.json file is not available then try OS environment vars
+        self.config = config if config is not None else cv_config.load_config()
+
+        # connect to MongoDB/Atlas
+        self.client = client if client is not None else cv_config.get_client(self.config)
+        self.db = self.client.get_database(self.config["mongodb"]["database"])
+        self.embed_location = cv_counties.embed_location(self.config)
+
+    # sha256 of the report file, reports are cached by content
+    def file_hash(self, file_name):
+        digest = hashlib.sha256()
+        with open(file_name, "rb") as report_file:
+            for block in iter(lambda: report_file.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    # cached cases always carry the location, older caches have no county codes
+    def read_cache(self, cache_dir, digest):
+        cache_file = path.join(cache_dir, f"{digest}.json")
+        if not path.exists(cache_file):
+            return None
+        with open(cache_file) as cached:
+            cases = json.load(cached)
+        counties = cv_counties.registry()
+        for case in cases:
+            case["date_added"] = datetime.fromisoformat(case["date_added"]) if case["date_added"] else None
+            case["county_code"] = counties.code(case["county"])
+            if not self.embed_location:
+                case.pop("location", None)
+        return cases
+
+    def write_cache(self, cache_dir, digest, cases):
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_file = path.join(cache_dir, f"{digest}.json")
+        with open(f"{cache_file}.tmp", "w") as cached:
+            json.dump(cases, cached, default=lambda value: value.isoformat())
+        os.replace(f"{cache_file}.tmp", cache_file)
+
+    # extract the case line list of every report not in the cache, page ranges run in a process pool
+    def extract_reports(self, files, cache_dir, workers, pages_per_task):
+        import pdfplumber
+
+        reports = {}
+        pending = []
+        for file_name in files:
+            digest = self.file_hash(file_name)
+            cases = self.read_cache(cache_dir, digest)
+            if cases is not None:
+                reports[file_name] = cases
+            else:
+                pending.append((file_name, digest))
+        print(f"{len(reports)} reports cached, {len(pending)} to extract.")
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            tasks = []
+            for file_name, digest in pending:
+                with pdfplumber.open(file_name) as pdf:
+                    page_count = len(pdf.pages)
+                ranges = [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+                futures = [executor.submit(cv_parsers.parse_report_pages, file_name, start, end) for start, end in ranges]
+                tasks.append((file_name, digest, futures))
+
+            for file_name, digest, futures in tasks:
+                cases = []
+                skipped = 0
+                for future in futures:
+                    page_cases, page_skipped = future.result()
+                    cases.extend(page_cases)
+                    skipped += page_skipped
+                print(f"Extracted {len(cases)} cases from {path.basename(file_name)}, skipped {skipped} unrecognized lines.")
+                self.write_cache(cache_dir, digest, cases)
+                reports[file_name] = self.read_cache(cache_dir, digest)
+
+        return reports
+
+    # every report goes to florida_reports for history
+    # with sync_florida the latest report's cases are also added to florida. The sync is partial, cases the report doesn't
+    # list are kept, but a report case replaces a stored case with the same case_number
+    def get_case_data(self, files, cache_dir, workers=None, pages_per_task=4, sync_florida=False):
+        try:
+            files = sorted(files)
+            if len(files) == 0:
+                return {
+                    "success": False,
+                    "message": "No reports"
+                }
+            reports = self.extract_reports(files, cache_dir, workers or os.cpu_count(), pages_per_task)
+
+            history = []
+            for file_name, cases in reports.items():
+                report = path.splitext(path.basename(file_name))[0]
+                for case in cases:
+                    history.append(dict(case, report=report, report_case=f"{report}:{case['case_number']}"))
+            history_result = cv_store.store_data(self.db, history, "florida_reports", "report_case", mode=self.config["mongodb"].get("sync", "diff"))
+            if not history_result["success"]:
+                return history_result
+
+            if not sync_florida:
+                return {
+                    "success": True,
+                    "message": f"{history_result['inserted']} report cases added",
+                    "new_cases": 0
+                }
+
+            latest = reports[files[-1]]
+            print(f"Storing {len(latest)} cases from {path.basename(files[-1])}.")
+            store_result = cv_store.store_data(self.db, latest, "florida", "case_number", mode=self.config["mongodb"].get("sync", "diff"), partial=True,
+                tracker=cv_store.Trackers(cv_daily.DailyCountTracker(), cv_cube.CubeTracker()))
+            if not store_result["success"]:
+                return store_result
+            cv_snapshot.write_snapshot(self.db, self.config["other"].get("snapshot_dir", "./snapshot"))
+
+        except Exception as e:
+            print(str(e))
+            return {
+                "success": False,
+                "message": str(e)
+            }
+
+        return {
+            "success": True,
+            "message": f"{store_result['inserted']} new cases added",
+            "new_cases": store_result["inserted"]
+        }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract the case line list from FLDOH daily report PDFs.")
+    parser.add_argument("files", nargs="*", help="report PDFs, defaults to datasets/pdf/*.pdf")
+    parser.add_argument("--cache-dir", default="./datasets/pdf/.cache")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--pages-per-task", type=int, default=4)
+    parser.add_argument("--sync-florida", action="store_true", help="also add the latest report's cases to the florida collection")
+    args = parser.parse_args()
+
+    bot = CoronavirusReports()
+    result = bot.get_case_data(args.files or glob.glob("./datasets/pdf/*.pdf"), args.cache_dir, args.workers, args.pages_per_task, args.sync_florida)
+    print(result["message"])
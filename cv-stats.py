@@ -1,59 +1,57 @@
-from pymongo import MongoClient
-from os import path, environ
 from datetime import datetime, date, timedelta
-import json
+import numpy as np
 import pandas as pd
+import cv_query
+import cv_config
+import cv_daily
+import cv_metrics
+import cv_counties
+import cv_forecast
 
 class CoronavirusStats():
     # constructor
-    def __init__(self):
+    def __init__(self, config=None, client=None, counts=None):
         # read config, if config.json file is not available then try OS environment vars
-        if path.exists('config.json'):
-            with open('config.json') as config_file:
-                self.config = json.load(config_file)
-        else:
-            self.config = {
-                "mongodb": {
-                    "url": environ.get("DATABASE_URL"),
-                    "database": environ.get("DATABASE_NAME")
-                },
-                "other": {
-                    "dashboard_url": environ.get("DASHBOARD_URL")
-                },
-                "smtp": {
-                    "user": environ.get("SMTP_USER"),
-                    "password": environ.get("SMTP_PASSWORD"),
-                    "email_from": environ.get("EMAIL_FROM"),
-                    "email_to": environ.get("EMAIL_TO"),
-                }
-            }
+        self.config = config if config is not None else cv_config.load_config()
+
+        # per stage timings and counters, Mongo commands are counted by the listener
+        self.metrics = cv_metrics.Metrics("cv-stats", self.config)
 
         # connect to MongoDB/Atlas
-        self.client = MongoClient(self.config["mongodb"]["url"])
+        self.client = client if client is not None else cv_config.get_client(self.config)
         self.db = self.client.get_database(self.config["mongodb"]["database"])
         today = datetime.today() - timedelta(days=1)
-        self.data = self.read_mongo("florida", {"date_added": {"$lt": today}})
+        with self.metrics.stage("load"):
+            # case counts per day from the local snapshot, or the materialized view kept up to date by ingest
+            if counts is None:
+                counts = cv_daily.load_counts(self.db, self.config["other"].get("snapshot_dir", "./snapshot"), today)
+            self.dirty_from = counts["dirty_from"]
+            self.snapshot = counts["snapshot"]
+            daily_counts = counts["daily"]
+            self.data = pd.DataFrame({
+                "date_added": [row["date"] for row in daily_counts],
+                "count": [row["count"] for row in daily_counts]
+            })
+            # per county counts for the forecasts
+            self.counties = cv_counties.registry()
+            county_counts = counts["county"]
+            self.county_data = pd.DataFrame({
+                "county_code": [self.counties.code(row["county"]) for row in county_counts],
+                "date_added": [row["date"] for row in county_counts],
+                "count": [row["count"] for row in county_counts]
+            })
+            self.metrics.count("load", "rows", len(daily_counts) + len(county_counts))
 
     # Convert MongoDB cursor to Pandas dataframe
-    def read_mongo(self, collection, query={}, no_id=True):
+    def read_mongo(self, collection, query={}, projection=None, no_id=True):
         """ Read from Mongo and Store into DataFrame """
-
-        # Make a query to the specific DB and Collection
-        cursor = self.db[collection].find(query)
-
-        # Expand the cursor and construct the DataFrame
-        df =  pd.DataFrame(list(cursor))
-
-        # Delete the _id
-        if no_id:
-            del df['_id']
-
-        return df
+        return cv_query.read_mongo(self.db, collection, query, projection, no_id)
 
     # get case count cumulative sum by date
     def cum_sum(self):
-        count_by_date = self.data.groupby("date_added")["case_number"].count()
-        return count_by_date.cumsum()
+        with self.metrics.stage("cum_sum", rows=len(self.data)):
+            count_by_date = self.data.set_index("date_added")["count"]
+            return count_by_date.cumsum()
 
     # calculate daily growth of case count
     def cum_growth(self, tail = None):
@@ -66,28 +64,65 @@ class CoronavirusStats():
             return growth_rate
 
 
-    # simulate case growth
-    def growth_sim(self, count, growth_factor):
-        cum_sum = self.cum_sum()        
-        prediction_dict = cum_sum.to_dict()
-        last_date = list(prediction_dict.keys())[-1]
-        last_count = prediction_dict[last_date]
-        predict_range = range(count)
-        for i in predict_range:
-            new_date = last_date + timedelta(days=1)
-            predicted_count = last_count * growth_factor
-            prediction_dict[new_date] = predicted_count
-            last_date = new_date
-            last_count = predicted_count
-        
-        return prediction_dict
-
-    # push stats
+    # cumulative counts of the state and every county over consecutive days, statewide first
+    def cum_sum_matrix(self):
+        dates = pd.date_range(self.data["date_added"].min(), self.data["date_added"].max(), freq="D")
+        statewide = self.data.groupby("date_added")["count"].sum().reindex(dates, fill_value=0)
+        counties = self.county_data[self.county_data["county_code"] != cv_counties.UNKNOWN]
+        counts = counties.pivot_table(index="county_code", columns="date_added", values="count", aggfunc="sum", fill_value=0)
+        counts = counts.reindex(index=range(len(self.counties)), columns=dates, fill_value=0)
+        return pd.concat([statewide.to_frame().T, counts]).cumsum(axis=1).to_numpy(dtype=float), dates
+
+    # forecast documents of every model, for the state and every county
+    def forecast(self, horizon=14, window=7):
+        with self.metrics.stage("forecast"):
+            matrix, dates = self.cum_sum_matrix()
+            forecasts = cv_forecast.forecast(matrix, horizon, window)
+            self.metrics.count("forecast", "rows", matrix.shape[0] * len(cv_forecast.MODELS))
+            days = [dates[-1].to_pydatetime() + timedelta(days=step) for step in range(horizon + 1)]
+            counties = [(cv_daily.STATEWIDE, None)] + [(name, code) for code, name in enumerate(self.counties.names)]
+            # doubling time of the fitted window, None when a series isn't growing or couldn't be fitted
+            doubling_days = [round(float(value), 2) if np.isfinite(value) else None for value in forecasts["doubling_days"]]
+            data = []
+            for model in cv_forecast.MODELS:
+                count, lower, upper = (forecasts[model][band].round(2).tolist() for band in ("count", "lower", "upper"))
+                for row, (county, code) in enumerate(counties):
+                    for step, day in enumerate(days):
+                        document = {
+                            "date": day,
+                            "count": count[row][step],
+                            "lower": lower[row][step],
+                            "upper": upper[row][step],
+                            "series": "predicted",
+                            "model": model,
+                            "horizon": step,
+                            "county": county,
+                            "county_code": code
+                        }
+                        if model == "doubling_time":
+                            document["doubling_days"] = doubling_days[row]
+                        data.append(document)
+            return data
+
+    # first date that needs republishing: anything ingest changed, plus days newly past the cutoff
+    def republish_from(self):
+        last_published = self.db.florida_growth.find_one({"series": "actual"}, {"date": 1}, sort=[("date", -1)])
+        if last_published is None:
+            return None
+        since = last_published["date"] + timedelta(days=1)
+        if self.dirty_from is not None:
+            since = min(since, self.dirty_from)
+        return since
+
+    # push stats, only dates from the first changed day onward are rewritten
     def push_stats(self, recalculate_sim = False):
-        
+        since = self.republish_from()
+        date_filter = {"date": {"$gte": since}} if since is not None else {}
+        print(f"Publishing growth stats from {since.date() if since is not None else 'the beginning'}.")
+
         # rebuild simulation
-        self.db.florida_growth.delete_many({"series": "actual"})
-        self.db.florida_growth_rates.delete_many({})
+        self.db.florida_growth.delete_many(dict({"series": "actual"}, **date_filter))
+        self.db.florida_growth_rates.delete_many(date_filter)
         if recalculate_sim:
             self.db.florida_growth.delete_many({"series": "predicted"})
 
@@ -95,27 +130,22 @@ class CoronavirusStats():
         current_growth = self.cum_sum().to_dict()
         data = []
         for date, count in current_growth.items():
-            data.append({
-                "date": date,
-                "count": count,
-                "series": "actual"
-            })
-
-        # simulate cumulated sums
-        if recalculate_sim:
-            # get average growth rate for the last 5 days
-            average_growth_rate = self.cum_growth(5).mean()
-            # simulate 14 days of growth at current growth rate
-            simulated_growth = stats.growth_sim(14, average_growth_rate)
-            for date, count in simulated_growth.items():
+            if since is None or date >= since:
                 data.append({
                     "date": date,
                     "count": count,
-                    "series": "predicted"
+                    "series": "actual"
                 })
-        
+
+        # forecast every county from the latest counts
+        if recalculate_sim and len(self.data) > 0:
+            other = self.config.get("other", {})
+            data.extend(self.forecast(int(other.get("forecast_days", 14)), int(other.get("forecast_window", 7))))
+
+
         try:
-            self.db.florida_growth.insert_many(data)    
+            if len(data) > 0:
+                self.db.florida_growth.insert_many(data)    
         except Exception as e:
             print(str(e))
 
@@ -123,16 +153,28 @@ class CoronavirusStats():
         data = []
         growth_rates = self.cum_growth().to_dict()
         for date, rate in growth_rates.items():
-            data.append({
-                "date": date,
-                "rate": rate
-            })
+            if since is None or date >= since:
+                data.append({
+                    "date": date,
+                    "rate": rate
+                })
         
         try:
-            self.db.florida_growth_rates.insert_many(data)    
+            if len(data) > 0:
+                self.db.florida_growth_rates.insert_many(data)    
         except Exception as e:
             print(str(e))
+
+        if self.dirty_from is not None:
+            cv_daily.clear_dirty(self.db, self.dirty_from)
         
 
-stats = CoronavirusStats()
-stats.push_stats()
+# counts can be passed in when they were already loaded by another job, see cv-jobs.py
+def main(config=None, client=None, counts=None):
+    stats = CoronavirusStats(config, client, counts)
+    with stats.metrics.stage("push_stats"):
+        stats.push_stats(recalculate_sim=True)
+    stats.metrics.write()
+
+if __name__ == "__main__":
+    main()
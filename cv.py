@@ -1,120 +1,167 @@
-from selenium import webdriver
-from pymongo import MongoClient
-import json
+from pymongo import UpdateOne
+import requests
 import re
-from os import path, environ
 from datetime import datetime
+from collections import Counter
+import numpy as np
 import smtplib
+import cv_daily
+import cv_cube
+import cv_config
+import cv_metrics
+import cv_counties
+import cv_cases
+import cv_store
+
+# lxml is only needed for the browser-free scraper
+try:
+    from lxml import html
+except ImportError:
+    html = None
 
 class Coronavirus():
     # constructor
-    def __init__(self):
+    def __init__(self, config=None, client=None):
         # read config, if config.json file is not available then try OS environment vars
-        if path.exists('config.json'):
-            with open('config.json') as config_file:
-                self.config = json.load(config_file)
-        else:
-            self.config = {
-                "mongodb": {
-                    "url": environ.get("DATABASE_URL"),
-                    "database": environ.get("DATABASE_NAME")
-                },
-                "other": {
-                    "chromedriver_binary": environ.get("CHROMEDRIVER_PATH"),
-                    "data_url": environ.get("DATA_URL"),
-                    "dashboard_url": environ.get("DASHBOARD_URL")
-                },
-                "smtp": {
-                    "user": environ.get("SMTP_USER"),
-                    "password": environ.get("SMTP_PASSWORD"),
-                    "email_from": environ.get("EMAIL_FROM"),
-                    "email_to": environ.get("EMAIL_TO"),
-                }
-            }
+        self.config = config if config is not None else cv_config.load_config()
 
-        # set up chromedriver options
-        chrome_options = webdriver.ChromeOptions()
-        chrome_options.add_argument("--headless")
-        chrome_options.add_argument("--no-sandbox")
-        chrome_options.add_argument("--disable-dev-shm-usage")
-        chrome_options.add_argument("--disable-gpu")
+        # chrome is only started if the page can't be scraped without it
+        self.driver = None
 
-        # set up selenium chrome driver
-        self.driver = webdriver.Chrome(self.config["other"]["chromedriver_binary"], options=chrome_options)
+        # per stage timings and counters, Mongo commands are counted by the listener
+        self.metrics = cv_metrics.Metrics("cv", self.config)
 
         # connect to MongoDB/Atlas
-        self.client = MongoClient(self.config["mongodb"]["url"])
+        self.client = client if client is not None else cv_config.get_client(self.config)
         self.db = self.client.get_database(self.config["mongodb"]["database"])
 
+    # set up selenium chrome driver
+    def get_driver(self):
+        if self.driver is None:
+            # selenium is only imported when the browser is actually needed
+            from selenium import webdriver
+
+            # set up chromedriver options
+            chrome_options = webdriver.ChromeOptions()
+            chrome_options.add_argument("--headless")
+            chrome_options.add_argument("--no-sandbox")
+            chrome_options.add_argument("--disable-dev-shm-usage")
+            chrome_options.add_argument("--disable-gpu")
+
+            self.driver = webdriver.Chrome(self.config["other"]["chromedriver_binary"], options=chrome_options)
+        return self.driver
+
+    def close_driver(self):
+        if self.driver is not None:
+            self.driver.quit()
+            self.driver = None
+
+    # fetch the page once and parse the case table without a browser
+    def get_rows_static(self):
+        if html is None:
+            raise Exception("lxml is not installed")
+
+        response = requests.get(self.config["other"]["data_url"])
+        response.raise_for_status()
+        self.metrics.count("scrape", "bytes", len(response.content))
+        document = html.fromstring(response.content)
+        tables = document.xpath('/html/body/div[1]/div[3]/div/div[2]/div[3]/div/div[2]/block/table')
+        if len(tables) == 0:
+            # layout changed, fall back to the first table with a County column
+            tables = document.xpath('//table[.//td[contains(normalize-space(.), "County")] or .//th[contains(normalize-space(.), "County")]]')
+        if len(tables) == 0:
+            raise Exception("Case table not found in page source")
+
+        # same whitespace handling as WebElement.text
+        return [[" ".join(cell.text_content().split()) for cell in row.iter('td')] for row in tables[0].iter('tr')]
+
+    # render the page in headless chrome for when the table is built by JavaScript
+    def get_rows_browser(self):
+        driver = self.get_driver()
+        driver.get(self.config["other"]["data_url"])
+        table = driver.find_element_by_xpath('/html/body/div[1]/div[3]/div/div[2]/div[3]/div/div[2]/block/table')
+        return [[cell.text for cell in row.find_elements_by_tag_name('td')] for row in table.find_elements_by_css_selector('tr')]
+
+    # scrape the case table rows, without a browser when possible
+    def get_rows(self):
+        mode = self.config["other"].get("scrape_mode", "auto")
+        if mode in ("auto", "static"):
+            try:
+                rows = self.get_rows_static()
+                if len(rows) > 2 or mode == "static":
+                    return rows
+                print("No case rows in page source, falling back to browser.")
+            except Exception as e:
+                if mode == "static":
+                    raise
+                print(f"Static scrape failed ({str(e)}), falling back to browser.")
+        return self.get_rows_browser()
+
     # scrape source data from FLDOH
     def get_data(self):
         try:
-            self.driver.get(self.config["other"]["data_url"])
-            table = self.driver.find_element_by_xpath('/html/body/div[1]/div[3]/div/div[2]/div[3]/div/div[2]/block/table')
-            # build a collection of cases (dictionaries)
-            row_num = 0
-            cases = []
-            for row in table.find_elements_by_css_selector('tr'):
-                if row_num >= 2:
-                    cells = row.find_elements_by_tag_name('td')
-                    case = {
-                        "case_number": int(re.sub("[^0-9]", "", cells[0].text)),
-                        "county": cells[1].text,
-                        "age": int(re.sub("[^0-9]", "", cells[2].text)) if cells[2].text.strip() else 'Unknown',
-                        "sex": cells[3].text,
-                        "travel": cells[4].text,
-                        "date_added": datetime.now()
-                    }
-                    cases.append(case)
-                row_num+=1
+            # build a table of cases, first two rows are headers
+            counties = cv_counties.registry()
+            with self.metrics.stage("scrape"):
+                rows = self.get_rows()[2:]
+            scraped = datetime.now()
+            cases = cv_cases.CaseTable.from_records([{
+                "case_number": int(re.sub("[^0-9]", "", cells[0])),
+                "county": cells[1],
+                "county_code": counties.code(cells[1]),
+                "age": int(re.sub("[^0-9]", "", cells[2])) if cells[2].strip() else 'Unknown',
+                "sex": cells[3],
+                "travel": cells[4],
+                "date_added": scraped
+            } for cells in rows])
 
             # store to database
-            store_result = self.store_data(cases)
-            self.driver.close()
-            self.client.close()
+            with self.metrics.stage("store", rows=len(cases)):
+                store_result = self.store_data(cases)
+            self.close_driver()
 
         except Exception as e:
             print(str(e))
-            self.driver.quit()
+            self.close_driver()
             return {
                 "success": False,
                 "message": str(e)
             }
         
+        message = "{} new cases, {} cases resolved and {} cases under investigation".format(store_result['new_cases'],
+            len(store_result['changes']), store_result['under_investigation'])
         return {
             "success": True,
-            "message": "{} new cases and {} cases under investigation".format(store_result['new_cases'], 
-                store_result['under_investigation'])
+            "message": message
         }
     
     # store case data to Atlas/MongoDB instance
     def store_data(self, cases):        
         records = self.db.florida
-        cursor = records.aggregate([
-            {
-                "$group": {
-                    "_id": None,
-                    "max_case": {"$max": "$case_number"}
-                }
-            }
-        ])
-        
-        result = list(cursor)
+        # the max lookup and the under investigation one are served by the case_number and travel indexes, these are
+        # built by cv-jobs.py indexes rather than on every scrape
 
         max_case_number = 0 
-        
-        if len(result) > 0:
-            max_case_number = result[0]['max_case']
+        last_case = records.find_one({}, {"case_number": 1, "_id": 0}, sort=[("case_number", -1)])
+        if last_case is not None:
+            max_case_number = last_case['case_number']
         
         # filter for new cases (case # > last case number added)
-        new_cases = list(filter(lambda item: item['case_number'] > max_case_number, cases))        
+        new_cases = cases.take(np.flatnonzero(cases.array("case_number") > max_case_number)) if len(cases) > 0 else cases
 
         # we'll refresh under investigation cases in case status changed
-        inv_cursor = records.find({"travel": "Under Investigation"}, {"case_number": 1})
-        under_investigation = list(map(lambda item: item['case_number'], list(inv_cursor)))
+        # whole documents, so the status changes can be applied to the cube and the content hash recomputed
+        tracker = cv_store.Trackers(cv_daily.DailyCountTracker(), cv_cube.CubeTracker())
+        inv_cursor = records.find({"travel": "Under Investigation"}, {"_id": 0})
+        under_investigation = {item['case_number']: item for item in inv_cursor}
         
-        # filter for cases that need updating (under investigation)
-        update_cases = list(filter(lambda item: item['case_number'] in under_investigation, cases))
+        # status changes for cases that were under investigation
+        scraped_travel = dict(zip(cases.values("case_number"), cases.values("travel")))
+        changes = {}
+        for case_number in under_investigation:
+            travel = scraped_travel.get(case_number)
+            if travel is not None and travel != "Under Investigation":
+                changes[case_number] = travel
 
         print("Found {} new cases.".format(len(new_cases)))
         print("Found {} cases under investigation.".format(len(under_investigation)))
@@ -122,14 +169,26 @@ class Coronavirus():
         try:
             if len(new_cases) > 0:
                 print("Adding new cases to database.")
-                self.db.florida.insert_many(new_cases)    
-            if len(update_cases) > 0:
-                print("Updating under investigation cases.")
-                for case in update_cases:
-                    self.db.florida.update_one(
-                        {"case_number": case['case_number']}, 
-                        {"$set": {"travel": case['travel']}},
-                        upsert=False)        
+                # hashed like every other writer, so the next diff sync doesn't see them as changed
+                cv_store.page_hashes(new_cases)
+                self.db.florida.insert_many(cv_store.documents(self.db, new_cases))
+                for case in new_cases:
+                    tracker.added(case)
+            if len(changes) > 0:
+                print("Updating {} under investigation cases.".format(len(changes)))
+                self.db.florida.bulk_write([
+                    UpdateOne({"case_number": case_number}, {"$set": {"travel": travel,
+                        "content_hash": cv_store.hash_record(dict(under_investigation[case_number], travel=travel))}})
+                    for case_number, travel in changes.items()
+                ], ordered=False)
+                for case_number, travel in changes.items():
+                    tracker.removed(under_investigation[case_number])
+                    tracker.added(dict(under_investigation[case_number], travel=travel))
+                # report what changed in this run
+                for travel, count in Counter(changes.values()).most_common():
+                    print("  Under Investigation -> {}: {}".format(travel, count))
+            if len(new_cases) > 0 or len(changes) > 0:
+                tracker.apply(self.db)
         except Exception as e:
             print(str(e))
             return {
@@ -141,7 +200,8 @@ class Coronavirus():
             "success": True,
             "message": "",
             "new_cases": len(new_cases),
-            "under_investigation": len(update_cases)
+            "under_investigation": len(under_investigation) - len(changes),
+            "changes": changes
         }
     
     # sends email notification with the specified message and analytics dashboard URL
@@ -168,6 +228,13 @@ class Coronavirus():
         print('Sent email notification')
         server.quit()
 
-bot = Coronavirus()
-result = bot.get_data()
-bot.send_mail(result['message'])
+# scrape the case table, store new cases and send the notification, see also cv-jobs.py
+def main(config=None, client=None):
+    bot = Coronavirus(config, client)
+    result = bot.get_data()
+    bot.send_mail(result['message'])
+    bot.metrics.write(result["success"])
+    return result
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+import hashlib
+import json
+import struct
+from array import array
+from datetime import datetime, timedelta
+import numpy as np
+import bson
+from bson.raw_bson import RawBSONDocument
+
+# column-wise in-memory table of case documents
+#   integer columns (case_number, county_code, age) - typed arrays
+#   date_added                                      - int32 day numbers
+#   every other field                               - dictionary encoded, int16 codes (int32 past 32767 values)
+# values that don't fit an integer column ("Unknown", None, a datetime with a time of day) are kept in a small list and
+# stored as one of the column's lowest values. Rows encode straight to raw BSON, and content hashes are built from per
+# value JSON fragments. Both match cv_store.hash_record and bson.encode of the equivalent dict.
+# every row has every field of the table. Decoded values are shared between rows, treat them as read only
+INTEGERS = {"case_number": "q", "county_code": "h", "age": "h"}
+DAYS = ["date_added"]
+EPOCH = datetime(1970, 1, 1)
+
+# lowest values of an integer column stand for values that don't fit it
+RESERVED = 1024
+LIMITS = {"h": (-2 ** 15, 2 ** 15 - 1), "i": (-2 ** 31, 2 ** 31 - 1), "q": (-2 ** 63, 2 ** 63 - 1)}
+
+def hashable(value):
+    try:
+        hash(value)
+        return True
+    except TypeError:
+        return False
+
+# dictionary key of a value, lists and dicts are keyed by their JSON
+def value_key(value):
+    if hashable(value):
+        return (type(value), value)
+    return (type(value), json.dumps(value, sort_keys=True, default=str))
+
+# "field": value as it appears in json.dumps(record, sort_keys=True, default=str)
+def json_fragment(value):
+    return json.dumps(value, sort_keys=True, default=str)
+
+# BSON element of a single field, as bson.encode writes it inside a document
+def bson_element(name, value):
+    return bson.encode({name: value})[4:-1]
+
+class IntegerColumn():
+    def __init__(self, name, typecode):
+        self.name = name
+        self.values = array(typecode)
+        self.low, self.high = LIMITS[typecode]
+        self.others = []
+        self.other_keys = {}
+        self.name_bytes = name.encode("utf-8") + b"\x00"
+
+    def __len__(self):
+        return len(self.values)
+
+    # raw value of a python value
+    def encode(self, value):
+        if type(value) is int and self.low + RESERVED <= value <= self.high:
+            return value
+        key = value_key(value)
+        if key not in self.other_keys:
+            if len(self.others) == RESERVED:
+                raise ValueError(f"Too many values that aren't integers in {self.name}.")
+            self.other_keys[key] = len(self.others)
+            self.others.append(value)
+        return self.low + self.other_keys[key]
+
+    def decode(self, raw):
+        return raw if raw >= self.low + RESERVED else self.others[raw - self.low]
+
+    def extend(self, values):
+        self.values.extend(self.encode(value) for value in values)
+
+    # values given as factorized codes into uniques, the codes' -1 picks the last unique
+    def extend_factorized(self, codes, uniques):
+        raw = np.array([self.encode(value) for value in uniques], dtype=self.values.typecode)
+        self.values.frombytes(raw[codes].tobytes())
+
+    def value(self, index):
+        return self.decode(self.values[index])
+
+    def fragment(self, index):
+        raw = self.values[index]
+        return str(raw) if raw >= self.low + RESERVED else json_fragment(self.others[raw - self.low])
+
+    def element(self, index):
+        raw = self.values[index]
+        if raw < self.low + RESERVED:
+            return bson_element(self.name, self.others[raw - self.low])
+        if -2 ** 31 <= raw < 2 ** 31:
+            return b"\x10" + self.name_bytes + struct.pack("<i", raw)
+        return b"\x12" + self.name_bytes + struct.pack("<q", raw)
+
+    def empty(self):
+        column = type(self)(self.name, self.values.typecode)
+        column.others = list(self.others)
+        column.other_keys = dict(self.other_keys)
+        return column
+
+    # NumPy view of the stored values
+    def array(self):
+        return np.frombuffer(self.values, dtype=self.values.typecode) if len(self.values) else np.array([], dtype=self.values.typecode)
+
+    # shares memory with the table unless the column holds values that aren't integers, those become NaN
+    def series(self):
+        values = self.array()
+        if len(self.others) == 0:
+            return values
+        return np.where(values >= self.low + RESERVED, values, np.nan)
+
+# datetimes at midnight as int32 days since 1970-01-01
+class DayColumn(IntegerColumn):
+    def __init__(self, name, typecode="i"):
+        super().__init__(name, typecode)
+        self.fragments = {}
+        self.elements = {}
+
+    def encode(self, value):
+        if type(value) is datetime and value.tzinfo is None and value == value.replace(hour=0, minute=0, second=0, microsecond=0):
+            return super().encode((value - EPOCH).days)
+        return super().encode(value)
+
+    def decode(self, raw):
+        return EPOCH + timedelta(days=raw) if raw >= self.low + RESERVED else self.others[raw - self.low]
+
+    def fragment(self, index):
+        raw = self.values[index]
+        if raw not in self.fragments:
+            self.fragments[raw] = json_fragment(self.decode(raw))
+        return self.fragments[raw]
+
+    def element(self, index):
+        raw = self.values[index]
+        if raw not in self.elements:
+            self.elements[raw] = bson_element(self.name, self.decode(raw))
+        return self.elements[raw]
+
+    def series(self):
+        values = self.array()
+        days = np.where(values >= self.low + RESERVED, values, np.iinfo(np.int64).min)
+        return days.astype(np.int64).astype("datetime64[D]").astype("datetime64[ns]")
+
+class CategoryColumn():
+    def __init__(self, name, typecode="h"):
+        self.name = name
+        self.codes = array(typecode)
+        self.values = []
+        self.keys = {}
+        self.fragments = []
+        self.elements = []
+
+    def __len__(self):
+        return len(self.codes)
+
+    def encode(self, value):
+        key = value_key(value)
+        code = self.keys.get(key)
+        if code is None:
+            code = len(self.values)
+            if code == LIMITS[self.codes.typecode][1]:
+                self.codes = array("i", self.codes)
+            self.keys[key] = code
+            self.values.append(value)
+            self.fragments.append(None)
+            self.elements.append(None)
+        return code
+
+    # each distinct object is only keyed once, the records keep them alive while the batch is encoded
+    def extend(self, values):
+        codes = {}
+        for value in values:
+            code = codes.get(id(value))
+            if code is None:
+                code = codes[id(value)] = self.encode(value)
+            self.codes.append(code)
+
+    def extend_factorized(self, codes, uniques):
+        mapped = np.array([self.encode(value) for value in uniques], dtype=np.int64)
+        self.codes.extend(mapped[codes].tolist())
+
+    def value(self, index):
+        return self.values[self.codes[index]]
+
+    def fragment(self, index):
+        code = self.codes[index]
+        if self.fragments[code] is None:
+            self.fragments[code] = json_fragment(self.values[code])
+        return self.fragments[code]
+
+    def element(self, index):
+        code = self.codes[index]
+        if self.elements[code] is None:
+            self.elements[code] = bson_element(self.name, self.values[code])
+        return self.elements[code]
+
+    def empty(self):
+        column = CategoryColumn(self.name, self.codes.typecode)
+        column.values = list(self.values)
+        column.keys = dict(self.keys)
+        column.fragments = list(self.fragments)
+        column.elements = list(self.elements)
+        return column
+
+    def array(self):
+        return np.frombuffer(self.codes, dtype=self.codes.typecode) if len(self.codes) else np.array([], dtype=self.codes.typecode)
+
+    # Categorical over the dictionary with None as missing, lists and dicts can't be categories and are decoded per row
+    def series(self):
+        import pandas as pd
+        codes = self.array()
+        if not all(hashable(value) for value in self.values):
+            return np.array(self.values + [None], dtype=object)[codes]
+        missing = self.keys.get((type(None), None))
+        if missing is None:
+            return pd.Categorical.from_codes(codes, categories=self.values)
+        positions = np.arange(len(self.values))
+        remap = positions - (positions > missing)
+        remap[missing] = -1
+        return pd.Categorical.from_codes(remap[codes], categories=self.values[:missing] + self.values[missing + 1:])
+
+def new_column(field):
+    if field in INTEGERS:
+        return IntegerColumn(field, INTEGERS[field])
+    if field in DAYS:
+        return DayColumn(field)
+    return CategoryColumn(field)
+
+# per record access without building a dict, see cv_daily.DailyCountTracker
+class CaseRow():
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, field):
+        if field == "content_hash" and self.table.hashes is not None:
+            return self.table.content_hash(self.index)
+        return self.table.columns[field].value(self.index)
+
+    def get(self, field, default=None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self.table.fields)
+
+    def to_dict(self):
+        return self.table.record(self.index)
+
+class CaseTable():
+    def __init__(self, fields):
+        self.fields = list(fields)
+        self.columns = {field: new_column(field) for field in self.fields}
+        # sha1 digests of the rows once content_hashes was called
+        self.hashes = None
+
+    # fields are taken in the order they first appear
+    @classmethod
+    def from_records(cls, records, fields=None):
+        if fields is None:
+            fields = {}
+            for record in records:
+                fields.update(dict.fromkeys(record))
+        table = cls(fields)
+        table.extend(records)
+        return table
+
+    def __len__(self):
+        return len(self.columns[self.fields[0]]) if len(self.fields) > 0 else 0
+
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError("case table index out of range")
+        return CaseRow(self, index % len(self))
+
+    def __iter__(self):
+        return (CaseRow(self, index) for index in range(len(self)))
+
+    def extend(self, records):
+        for field, column in self.columns.items():
+            column.extend([record.get(field) for record in records])
+        self.hashes = None
+
+    # add rows from factorized columns, field -> (codes, uniques), see cv_transform.map_unique
+    def extend_factorized(self, columns):
+        for field, column in self.columns.items():
+            codes, uniques = columns[field]
+            column.extend_factorized(codes, uniques)
+        self.hashes = None
+
+    # decoded values of a field
+    def values(self, field):
+        if len(self) == 0:
+            return []
+        column = self.columns[field]
+        return [column.value(index) for index in range(len(column))]
+
+    # raw values (integers, day numbers or dictionary codes) of a field, shares memory with the table
+    # the table can't grow while a view is held
+    def array(self, field):
+        return self.columns[field].array()
+
+    # new table with the rows at the given positions
+    def take(self, indices):
+        table = CaseTable(self.fields)
+        indices = np.asarray(indices, dtype=np.int64)
+        for field, column in self.columns.items():
+            subset = column.empty()
+            stored = subset.values if isinstance(subset, IntegerColumn) else subset.codes
+            stored.frombytes(column.array()[indices].tobytes())
+            table.columns[field] = subset
+        if self.hashes is not None:
+            table.hashes = b"".join(self.hashes[index * 20:index * 20 + 20] for index in indices.tolist())
+        return table
+
+    # content hashes as cv_store.hash_record computes them, without building the records
+    def content_hashes(self):
+        if self.hashes is None:
+            fields = sorted(field for field in self.fields if field not in ("_id", "content_hash"))
+            names = [f"{json.dumps(field)}: " for field in fields]
+            columns = [self.columns[field] for field in fields]
+            digests = bytearray()
+            for index in range(len(self)):
+                encoded = "{" + ", ".join(name + column.fragment(index) for name, column in zip(names, columns)) + "}"
+                digests += hashlib.sha1(encoded.encode("utf-8")).digest()
+            self.hashes = bytes(digests)
+        return [self.content_hash(index) for index in range(len(self))]
+
+    def content_hash(self, index):
+        return self.hashes[index * 20:index * 20 + 20].hex()
+
+    def record(self, index):
+        record = {field: self.columns[field].value(index) for field in self.fields}
+        if self.hashes is not None:
+            record["content_hash"] = self.content_hash(index)
+        return record
+
+    def to_records(self):
+        return [self.record(index) for index in range(len(self))]
+
+    # a row as raw BSON, fields in table order followed by the content hash
+    def document(self, index):
+        body = b"".join(self.columns[field].element(index) for field in self.fields)
+        if self.hashes is not None:
+            body += b"\x02content_hash\x00" + struct.pack("<i", 41) + self.content_hash(index).encode("ascii") + b"\x00"
+        return RawBSONDocument(struct.pack("<i", len(body) + 5) + body + b"\x00")
+
+    def documents(self):
+        return [self.document(index) for index in range(len(self))]
+
+    # raw BSON documents in insert_many sized batches
+    def bson_batches(self, batch_size=1000):
+        for start in range(0, len(self), batch_size):
+            yield [self.document(index) for index in range(start, min(start + batch_size, len(self)))]
+
+    # DataFrame over the columns, integer columns are shared with the table, categoricals reuse the dictionaries
+    def to_frame(self):
+        import pandas as pd
+        return pd.DataFrame({field: self.columns[field].series() for field in self.fields}, copy=False)
@@ -0,0 +1,61 @@
+import json
+from os import path, environ
+from pymongo import MongoClient
+import cv_metrics
+
+# read config, if config.json file is not available then try OS environment vars
+def load_config(config_file="config.json"):
+    if path.exists(config_file):
+        with open(config_file) as config_json:
+            return json.load(config_json)
+
+    return {
+        "mongodb": {
+            "url": environ.get("DATABASE_URL"),
+            "database": environ.get("DATABASE_NAME"),
+            "sync": environ.get("DATABASE_SYNC", "diff")
+        },
+        "other": {
+            "chromedriver_binary": environ.get("CHROMEDRIVER_PATH"),
+            "data_url": environ.get("DATA_URL"),
+            "scrape_mode": environ.get("SCRAPE_MODE", "auto"),
+            "dashboard_url": environ.get("DASHBOARD_URL"),
+            "snapshot_dir": environ.get("SNAPSHOT_DIR", "./snapshot"),
+            "metrics_dir": environ.get("METRICS_DIR", "./metrics"),
+            "http_cache_dir": environ.get("HTTP_CACHE_DIR", "./http_cache"),
+            "profile": environ.get("CV_PROFILE"),
+            "embed_location": environ.get("EMBED_LOCATION", "true"),
+            "forecast_days": environ.get("FORECAST_DAYS", 14),
+            "forecast_window": environ.get("FORECAST_WINDOW", 7)
+        },
+        "smtp": {
+            "user": environ.get("SMTP_USER"),
+            "password": environ.get("SMTP_PASSWORD"),
+            "email_from": environ.get("EMAIL_FROM"),
+            "email_to": environ.get("EMAIL_TO"),
+        },
+        "api": {
+            "url": environ.get("API_URL"),
+            "daily_url": environ.get("DAILY_STATS_API_URL"),
+            "state": environ.get("DAILY_STATS_STATE", "FL"),
+            "concurrency": environ.get("API_CONCURRENCY", 4),
+            "requests_per_second": environ.get("API_REQUESTS_PER_SECOND", 2),
+            "max_in_flight_pages": environ.get("API_MAX_IN_FLIGHT_PAGES", 8),
+            "incremental": environ.get("API_INCREMENTAL", "true").lower() == "true",
+            "full_refresh_days": environ.get("API_FULL_REFRESH_DAYS", 7),
+        }
+    }
+
+# one pooled client per URL, shared by every job run in this process
+clients = {}
+
+def get_client(config):
+    url = config["mongodb"]["url"]
+    if url not in clients:
+        clients[url] = MongoClient(url, maxPoolSize=int(config["mongodb"].get("pool_size", 10)), event_listeners=[cv_metrics.mongo_listener])
+    return clients[url]
+
+def close_clients():
+    for client in clients.values():
+        client.close()
+    clients.clear()
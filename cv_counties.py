@@ -0,0 +1,102 @@
+import json
+import re
+from functools import lru_cache
+from os import path
+import numpy as np
+
+# process-wide registry of the Florida counties, florida_counties.json is read once per process
+# a county's code is its position in florida_counties.json. Codes are stored with the cases, so only append new counties
+# the sources spell some counties differently ("St. Johns", "St.Johns", "Saint Johns", "Miami-Dade", "Desoto"),
+# every spelling resolves to the same code
+COUNTIES_FILE = path.join(path.dirname(path.abspath(__file__)), "datasets", "json", "florida_counties.json")
+UNKNOWN = -1
+
+# spellings that don't reduce to the registered name by dropping case, spaces and punctuation
+ALIASES = {
+    "miamidade": "dade",
+    "saintjohns": "stjohns",
+    "saintlucie": "stlucie"
+}
+
+def normalize(name):
+    key = re.sub("[^a-z]", "", name.lower())
+    return ALIASES.get(key, key)
+
+class CountyRegistry():
+    def __init__(self, counties):
+        self.names = [county["county"] for county in counties]
+        self.population = np.array([county["population"] for county in counties], dtype=np.int64)
+        # longitude, latitude per code
+        self.coordinates = np.array([county["location"]["coordinates"] for county in counties], dtype=np.float64)
+        self.keys = {normalize(name): code for code, name in enumerate(self.names)}
+        # spellings seen so far, a source only uses a few dozen
+        self.codes = {}
+        # names that aren't counties ("Unknown") get process local codes past the registered ones
+        self.interned = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    # registered code of a name, UNKNOWN for anything that isn't a Florida county
+    def code(self, name):
+        if name is None:
+            return UNKNOWN
+        code = self.codes.get(name)
+        if code is None:
+            code = self.keys.get(normalize(name), UNKNOWN)
+            self.codes[name] = code
+        return code
+
+    # like code, but other names get a code too, only valid in this process
+    def intern(self, name):
+        code = self.code(name)
+        if code != UNKNOWN:
+            return code
+        if name not in self.interned:
+            self.interned[name] = len(self.names) + len(self.interned)
+        return self.interned[name]
+
+    def name(self, code):
+        if 0 <= code < len(self.names):
+            return self.names[code]
+        for name, interned in self.interned.items():
+            if interned == code:
+                return name
+        return None
+
+    # registered code, or UNKNOWN for interned ones
+    def registered(self, code):
+        return code if 0 <= code < len(self.names) else UNKNOWN
+
+    # population per code, NaN where it isn't known
+    def population_of(self, codes):
+        codes = np.asarray(codes, dtype=np.int64)
+        known = (codes >= 0) & (codes < len(self.names))
+        population = np.full(len(codes), np.nan)
+        population[known] = self.population[codes[known]]
+        return population
+
+    # GeoJSON point of a county, built from the coordinate arrays on demand
+    def location(self, code):
+        if not 0 <= code < len(self.names):
+            return None
+        return {"type": "Point", "coordinates": self.coordinates[code].tolist()}
+
+    # documents of the counties collection, geography is joined to cases and stats by county_code
+    def documents(self):
+        return [{
+            "county_code": code,
+            "county": name,
+            "population": int(self.population[code]),
+            "location": self.location(code)
+        } for code, name in enumerate(self.names)]
+
+@lru_cache(maxsize=None)
+def registry():
+    with open(COUNTIES_FILE) as counties_file:
+        return CountyRegistry(json.load(counties_file))
+
+# whether case documents keep a copy of their county's GeoJSON location
+def embed_location(config):
+    value = (config or {}).get("other", {}).get("embed_location", True)
+    return value if isinstance(value, bool) else str(value).lower() == "true"
@@ -0,0 +1,116 @@
+from collections import Counter
+from pymongo import DeleteOne, UpdateOne
+import cv_counties
+import cv_indexes
+from cv_daily import day_of
+from cv_rolling import age_band, AGE_BANDS
+
+# pre-aggregated case counts for the charts dashboard, so views read a few hundred cells instead of grouping florida
+#   florida_cube        - one document per date x county x age band x sex
+#   florida_cube_totals - the same cells without the date, for the all-time charts
+# every cell counts its cases and, per outcome, the cases that answered yes. Outcomes are measures rather than a
+# dimension since one case can be hospitalized, visit the ED and die
+COLLECTION = "florida_cube"
+TOTALS = "florida_cube_totals"
+OUTCOMES = ["hospitalized", "deceased", "ed_visit", "travel"]
+# FLDOH marks recent deaths separately
+YES = ["Yes", "Recent"]
+
+def cell(doc):
+    return (day_of(doc.get("date_added")), doc.get("county"), AGE_BANDS[age_band(doc.get("age"))], doc.get("sex"))
+
+def measures(doc):
+    values = {"cases": 1}
+    for outcome in OUTCOMES:
+        values[outcome] = 1 if doc.get(outcome) in YES else 0
+    return values
+
+def cell_document(key, values):
+    date, county, band, sex = key
+    document = {
+        "county": county,
+        "county_code": cv_counties.registry().code(county),
+        "age_band": band,
+        "sex": sex
+    }
+    if date is not None:
+        document["date"] = date
+    document.update(values)
+    return document
+
+# collects $inc deltas of the cells touched while cases are written, see cv_store.store_pages
+class CubeTracker():
+    # fields store_pages needs from stored documents to report removals
+    fields = ["date_added", "county", "age", "sex"] + OUTCOMES
+
+    def __init__(self):
+        self.deltas = {}
+        self.rebuilt = False
+
+    def add(self, doc, sign):
+        totals = self.deltas.setdefault(cell(doc), Counter())
+        for measure, value in measures(doc).items():
+            totals[measure] += sign * value
+
+    def added(self, doc):
+        self.add(doc, 1)
+
+    def removed(self, doc):
+        self.add(doc, -1)
+
+    # the whole collection was replaced, deltas are meaningless
+    def rebuild(self):
+        self.rebuilt = True
+
+    def apply(self, db):
+        # the cube was never built, deltas alone would undercount
+        if self.rebuilt or db[COLLECTION].find_one({}, {"_id": 1}) is None:
+            rebuild_cube(db)
+        else:
+            apply_deltas(db, self.deltas)
+
+# add per cell deltas to both cubes, cells left without cases are dropped
+# only cells that lost cases are checked, by their cell index (see cv_indexes.INDEXES) instead of a scan on cases
+def apply_deltas(db, deltas):
+    cells = {key: values for key, values in deltas.items() if key[0] is not None}
+    totals = {}
+    for key, values in cells.items():
+        totals.setdefault((None,) + key[1:], Counter()).update(values)
+    for collection, values in ((COLLECTION, cells), (TOTALS, totals)):
+        operations = []
+        emptied = []
+        for key, counts in values.items():
+            # every measure is incremented, so new cells start with all of them
+            if any(count != 0 for count in counts.values()):
+                operations.append(UpdateOne(cell_document(key, {}), {"$inc": dict(counts)}, upsert=True))
+            if counts["cases"] < 0:
+                emptied.append(DeleteOne(dict(cell_document(key, {}), cases={"$lte": 0})))
+        # separate bulks, an unordered one may run its deletes before the updates
+        for bulk in (operations, emptied):
+            if len(bulk) > 0:
+                db[collection].bulk_write(bulk, ordered=False)
+
+# recompute both cubes with one grouped pass over the florida collection
+def rebuild_cube(db):
+    print(f"Rebuilding {COLLECTION}.")
+    group = {"_id": {"date_added": "$date_added", "county": "$county", "age": "$age", "sex": "$sex"}, "cases": {"$sum": 1}}
+    for outcome in OUTCOMES:
+        group[outcome] = {"$sum": {"$cond": [{"$in": [f"${outcome}", YES]}, 1, 0]}}
+    cells = {}
+    totals = {}
+    for row in db.florida.aggregate([{"$group": group}], allowDiskUse=True):
+        key = cell(row["_id"])
+        if key[0] is None:
+            continue
+        for target, target_key in ((cells, key), (totals, (None,) + key[1:])):
+            target.setdefault(target_key, Counter()).update({measure: row[measure] for measure in ["cases"] + OUTCOMES})
+
+    for collection, values in ((COLLECTION, cells), (TOTALS, totals)):
+        staging = db[f"{collection}_staging"]
+        staging.drop()
+        if len(values) == 0:
+            db[collection].delete_many({})
+            continue
+        staging.insert_many([cell_document(key, dict(counts)) for key, counts in values.items()])
+        cv_indexes.copy_indexes(db, collection, staging.name)
+        staging.rename(collection, dropTarget=True)
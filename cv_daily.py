@@ -0,0 +1,138 @@
+from collections import Counter
+from pymongo import DeleteOne, UpdateOne
+
+# materialized case counts per day, per county plus a statewide row
+COLLECTION = "florida_daily_counts"
+STATEWIDE = "All"
+
+# cases are counted by calendar day
+def day_of(date_added):
+    if date_added is None:
+        return None
+    return date_added.replace(hour=0, minute=0, second=0, microsecond=0)
+
+# collects $inc deltas while cases are written, see cv_store.store_pages
+class DailyCountTracker():
+    # fields store_pages needs from stored documents to report removals
+    fields = ["date_added", "county"]
+
+    def __init__(self):
+        self.deltas = Counter()
+        self.rebuilt = False
+
+    def added(self, doc):
+        self.deltas[(day_of(doc.get("date_added")), doc.get("county"))] += 1
+
+    def removed(self, doc):
+        self.deltas[(day_of(doc.get("date_added")), doc.get("county"))] -= 1
+
+    # the whole collection was replaced, deltas are meaningless
+    def rebuild(self):
+        self.rebuilt = True
+
+    def apply(self, db):
+        # counts were never materialized, deltas alone would undercount
+        if self.rebuilt or db[COLLECTION].find_one({}, {"_id": 1}) is None:
+            rebuild_daily_counts(db)
+        else:
+            apply_deltas(db, self.deltas)
+
+# add per (day, county) deltas to the materialized counts and mark the first changed day
+# days left without cases are dropped like a rebuild would, looked up by the (county, date) index
+def apply_deltas(db, deltas):
+    totals = Counter()
+    for (day, county), delta in deltas.items():
+        if day is not None and delta != 0:
+            totals[(day, county)] += delta
+            totals[(day, STATEWIDE)] += delta
+    if len(totals) == 0:
+        return
+
+    changed = {key: delta for key, delta in totals.items() if delta != 0}
+    for bulk in (
+        [UpdateOne({"date": day, "county": county}, {"$inc": {"count": delta}}, upsert=True) for (day, county), delta in changed.items()],
+        [DeleteOne({"date": day, "county": county, "count": {"$lte": 0}}) for (day, county), delta in changed.items() if delta < 0]
+    ):
+        if len(bulk) > 0:
+            db[COLLECTION].bulk_write(bulk, ordered=False)
+    mark_dirty(db, min(day for day, county in totals.keys()))
+
+# recompute the materialized counts from the florida collection
+def rebuild_daily_counts(db):
+    print(f"Rebuilding {COLLECTION}.")
+    totals = Counter()
+    pipeline = [{"$group": {"_id": {"date_added": "$date_added", "county": "$county"}, "count": {"$sum": 1}}}]
+    for row in db.florida.aggregate(pipeline, allowDiskUse=True):
+        day = day_of(row["_id"].get("date_added"))
+        if day is not None:
+            totals[(day, row["_id"].get("county"))] += row["count"]
+            totals[(day, STATEWIDE)] += row["count"]
+
+    staging = db[f"{COLLECTION}_staging"]
+    staging.drop()
+    if len(totals) == 0:
+        db[COLLECTION].delete_many({})
+        return
+    staging.insert_many([{"date": day, "county": county, "count": count} for (day, county), count in totals.items()])
+    staging.create_index([("county", 1), ("date", 1)], unique=True)
+    staging.rename(COLLECTION, dropTarget=True)
+    mark_dirty(db, min(day for day, county in totals.keys()))
+
+# remember the earliest day whose counts changed since stats were last published
+def mark_dirty(db, day):
+    db.ingest_state.update_one({"_id": COLLECTION}, {"$min": {"dirty_from": day}}, upsert=True)
+
+def get_dirty_from(db):
+    state = db.ingest_state.find_one({"_id": COLLECTION})
+    return state.get("dirty_from") if state else None
+
+# stats caught up to dirty_from, leave anything marked since then alone
+def clear_dirty(db, dirty_from):
+    db.ingest_state.update_one({"_id": COLLECTION, "dirty_from": dirty_from}, {"$unset": {"dirty_from": ""}})
+
+# read counts for one county (or STATEWIDE) as rows of date/count
+def read_daily_counts(db, county=STATEWIDE, before=None):
+    query = {"county": county}
+    if before is not None:
+        query["date"] = {"$lt": before}
+    return list(db[COLLECTION].find(query, {"_id": 0, "date": 1, "count": 1}).sort("date", 1))
+
+# read counts for every county (statewide rows excluded) as rows of date/county/count
+def read_county_counts(db, before=None):
+    query = {"county": {"$ne": STATEWIDE}}
+    if before is not None:
+        query["date"] = {"$lt": before}
+    return list(db[COLLECTION].find(query, {"_id": 0, "date": 1, "county": 1, "count": 1}))
+
+# statewide and per county counts in one read, from the snapshot when it's current, shared by the stats jobs
+def load_counts(db, snapshot_dir, before=None):
+    import cv_snapshot
+
+    # first day whose counts changed since the last run, read before the counts themselves
+    dirty_from = get_dirty_from(db)
+    snapshot = cv_snapshot.load_current(db, snapshot_dir)
+    if snapshot is not None:
+        return {
+            "dirty_from": dirty_from,
+            "snapshot": snapshot,
+            "daily": snapshot.daily_counts(before),
+            "county": snapshot.county_counts(before)
+        }
+
+    if db[COLLECTION].find_one({}, {"_id": 1}) is None:
+        rebuild_daily_counts(db)
+        dirty_from = get_dirty_from(db)
+    query = {"date": {"$lt": before}} if before is not None else {}
+    daily = []
+    county = []
+    for row in db[COLLECTION].find(query, {"_id": 0, "date": 1, "county": 1, "count": 1}).sort("date", 1):
+        if row.get("county") == STATEWIDE:
+            daily.append({"date": row["date"], "count": row["count"]})
+        else:
+            county.append(row)
+    return {
+        "dirty_from": dirty_from,
+        "snapshot": None,
+        "daily": daily,
+        "county": county
+    }
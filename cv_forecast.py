@@ -0,0 +1,103 @@
+import numpy as np
+
+# case forecasts for many cumulative series at once, one row per series and one column per day
+# every model fits the last `window` days of each row and projects days 1..horizon
+#   exponential    - least squares line through log(count), prediction interval of the fit
+#   rolling_growth - mean daily growth factor (what cv-stats.py growth_sim used), band from the spread of daily log growth
+#   doubling_time  - doubling time over the window, band from the doubling times of the windows ending on earlier days
+# forecasts never fall below the last count, rows that are still zero stay zero
+MODELS = ["exponential", "rolling_growth", "doubling_time"]
+# two sided 95% band
+Z = 1.96
+
+def log_counts(matrix):
+    with np.errstate(divide="ignore"):
+        return np.where(matrix > 0, np.log(np.where(matrix > 0, matrix, 1)), np.nan)
+
+# nanmean/nanstd that return NaN for empty rows without warnings
+def row_mean(values):
+    valid = ~np.isnan(values)
+    count = valid.sum(axis=1)
+    total = np.where(valid, values, 0).sum(axis=1)
+    return np.divide(total, count, out=np.full(len(values), np.nan), where=count > 0), count
+
+def row_std(values):
+    mean, count = row_mean(values)
+    squares = np.where(np.isnan(values), 0, (values - mean[:, None]) ** 2).sum(axis=1)
+    return np.sqrt(np.divide(squares, count - 1, out=np.zeros(len(values)), where=count > 1))
+
+def exponential(log_matrix, steps, window):
+    recent = log_matrix[:, -window:]
+    t = np.arange(recent.shape[1], dtype=float)
+    valid = ~np.isnan(recent)
+    n = valid.sum(axis=1)
+    safe_n = np.maximum(n, 1)
+    t_mean = (t * valid).sum(axis=1) / safe_n
+    y_mean = np.where(valid, recent, 0).sum(axis=1) / safe_n
+    t_dev = np.where(valid, t - t_mean[:, None], 0)
+    sxx = (t_dev ** 2).sum(axis=1)
+    slope = np.divide((t_dev * np.where(valid, recent - y_mean[:, None], 0)).sum(axis=1), sxx, out=np.zeros(len(recent)), where=sxx > 0)
+    intercept = y_mean - slope * t_mean
+    residuals = np.where(valid, recent - (intercept[:, None] + slope[:, None] * t), 0)
+    sigma = np.sqrt(np.divide((residuals ** 2).sum(axis=1), n - 2, out=np.zeros(len(recent)), where=n > 2))
+
+    at = t[-1] + steps
+    mean = intercept[:, None] + slope[:, None] * at
+    spread = sigma[:, None] * np.sqrt(1 + 1 / safe_n[:, None] + np.divide((at - t_mean[:, None]) ** 2, sxx[:, None], out=np.zeros((len(recent), len(steps))), where=sxx[:, None] > 0))
+    fitted = n >= 2
+    return np.where(fitted[:, None], mean, np.nan), np.where(fitted[:, None], Z * spread, np.nan)
+
+def rolling_growth(log_matrix, steps, window):
+    growth = np.diff(log_matrix[:, -(window + 1):], axis=1)
+    factor, count = row_mean(np.exp(growth))
+    spread = row_std(growth)
+    last = log_matrix[:, -1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = last[:, None] + np.log(factor)[:, None] * steps
+    return mean, Z * spread[:, None] * np.sqrt(steps)
+
+def doubling_time(log_matrix, steps, window):
+    # daily log growth over the window ending on each of the last `window` days, newest first
+    rates = np.stack([
+        (log_matrix[:, -1 - offset] - log_matrix[:, -1 - offset - window]) / window
+        for offset in range(window) if window + offset < log_matrix.shape[1]
+    ], axis=1) if log_matrix.shape[1] > window else np.full((len(log_matrix), 1), np.nan)
+    rate = rates[:, 0]
+    spread = row_std(rates)
+    mean = log_matrix[:, -1][:, None] + rate[:, None] * steps
+    return mean, Z * spread[:, None] * steps, rate
+
+# forecasts of every row of a cumulative count matrix with at least one day
+# returns {model: {"count", "lower", "upper"}} with arrays of rows x (horizon + 1), column 0 is the last count,
+# and "doubling_days" per row (inf when a row isn't growing, NaN when it can't be estimated)
+def forecast(matrix, horizon=14, window=7):
+    matrix = np.asarray(matrix, dtype=float)
+    steps = np.arange(horizon + 1, dtype=float)
+    last = matrix[:, -1] if matrix.shape[1] > 0 else np.zeros(len(matrix))
+    log_matrix = log_counts(matrix)
+    window = max(2, min(window, matrix.shape[1] - 1)) if matrix.shape[1] > 2 else 1
+
+    results = {}
+    fits = {
+        "exponential": exponential(log_matrix, steps, window),
+        "rolling_growth": rolling_growth(log_matrix, steps, window),
+        "doubling_time": doubling_time(log_matrix, steps, window)
+    }
+    for model in MODELS:
+        mean, spread = fits[model][:2]
+        with np.errstate(over="ignore", invalid="ignore"):
+            count, lower, upper = np.exp(mean), np.exp(mean - spread), np.exp(mean + spread)
+        # rows without a fit stay flat
+        count = np.where(np.isfinite(count), np.maximum(count, last[:, None]), last[:, None])
+        results[model] = {
+            "count": count,
+            "lower": np.where(np.isfinite(lower), np.clip(lower, last[:, None], count), last[:, None]),
+            "upper": np.where(np.isfinite(upper), np.maximum(upper, count), count)
+        }
+        for band in results[model].values():
+            band[:, 0] = last
+
+    rate = fits["doubling_time"][2]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        results["doubling_days"] = np.where(rate > 0, np.log(2) / rate, np.where(np.isnan(rate), np.nan, np.inf))
+    return results
@@ -0,0 +1,211 @@
+import gzip
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+# on-disk cache for GET requests, keyed by URL and params
+#   <directory>/<key>.json - validators, freshness and the content hash of the body
+#   <directory>/<key>.gz   - gzip compressed body
+# fresh entries (Cache-Control max-age / Expires) are served without a request, stale ones are revalidated
+# with If-None-Match / If-Modified-Since, a 304 serves the stored body
+CACHED_HEADERS = ("ETag", "Last-Modified", "Cache-Control", "Expires")
+
+class CachedResponse():
+    def __init__(self, status_code, headers, content, content_hash, from_cache, downloaded, raw=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.content_hash = content_hash
+        self.from_cache = from_cache
+        # body bytes that actually came over the wire
+        self.downloaded = downloaded
+        # file-like body of a streamed response
+        self.raw = raw
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception(f"HTTP {self.status_code}")
+
+def content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+# Cache-Control directives as a dict, valueless directives map to True
+def parse_cache_control(value):
+    directives = {}
+    for directive in (value or "").split(","):
+        name, _, argument = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"') if argument else True
+    return directives
+
+# epoch seconds until which a response can be served without revalidation
+def fresh_until(headers, now):
+    directives = parse_cache_control(headers.get("Cache-Control"))
+    if "no-cache" in directives or "no-store" in directives:
+        return 0
+    if "max-age" in directives:
+        try:
+            return now + int(directives["max-age"])
+        except ValueError:
+            return 0
+    if headers.get("Expires"):
+        try:
+            return parsedate_to_datetime(headers["Expires"]).timestamp()
+        except (TypeError, ValueError):
+            return 0
+    return 0
+
+# reads a response body while writing it to the cache and hashing it
+class TeeReader():
+    def __init__(self, raw, body_path):
+        self.raw = raw
+        self.body_path = body_path
+        self.body_file = gzip.open(f"{body_path}.tmp", "wb")
+        self.digest = hashlib.sha256()
+        self.bytes = 0
+
+    def read(self, size=-1):
+        chunk = self.raw.read(size if size is not None and size >= 0 else None, decode_content=True)
+        self.digest.update(chunk)
+        self.body_file.write(chunk)
+        self.bytes += len(chunk)
+        return chunk
+
+    # read whatever the consumer left and move the body into place
+    def finish(self):
+        while len(self.read(1024 * 1024)) > 0:
+            pass
+        self.body_file.close()
+        os.replace(f"{self.body_path}.tmp", self.body_path)
+        return self.digest.hexdigest()
+
+    def discard(self):
+        self.body_file.close()
+        os.remove(f"{self.body_path}.tmp")
+
+class HttpCache():
+    def __init__(self, directory):
+        self.directory = directory
+
+    def key(self, url, params):
+        encoded = json.dumps([url, sorted((str(name), str(value)) for name, value in (params or {}).items())])
+        return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+    def read_meta(self, key):
+        meta_path = os.path.join(self.directory, f"{key}.json")
+        if not os.path.exists(meta_path) or not os.path.exists(os.path.join(self.directory, f"{key}.gz")):
+            return None
+        with open(meta_path) as meta_file:
+            return json.load(meta_file)
+
+    def read_entry(self, key):
+        meta = self.read_meta(key)
+        if meta is None:
+            return None, None
+        with gzip.open(os.path.join(self.directory, f"{key}.gz"), "rb") as body_file:
+            return meta, body_file.read()
+
+    def conditional_headers(self, meta):
+        headers = {}
+        if meta is not None:
+            if meta["headers"].get("ETag"):
+                headers["If-None-Match"] = meta["headers"]["ETag"]
+            if meta["headers"].get("Last-Modified"):
+                headers["If-Modified-Since"] = meta["headers"]["Last-Modified"]
+        return headers
+
+    # validators and freshness can be updated by a 304
+    def revalidated(self, key, meta, response, now):
+        for name in CACHED_HEADERS:
+            if response.headers.get(name):
+                meta["headers"][name] = response.headers[name]
+        meta["fresh_until"] = fresh_until(meta["headers"], now)
+        self.write_entry(key, meta)
+
+    def new_meta(self, url, headers, digest, now):
+        return {
+            "url": url,
+            "headers": headers,
+            "fresh_until": fresh_until(headers, now),
+            "content_hash": digest,
+            "stored": now
+        }
+
+    def write_entry(self, key, meta, content=None):
+        os.makedirs(self.directory, exist_ok=True)
+        if content is not None:
+            body_path = os.path.join(self.directory, f"{key}.gz")
+            with gzip.open(f"{body_path}.tmp", "wb") as body_file:
+                body_file.write(content)
+            os.replace(f"{body_path}.tmp", body_path)
+        meta_path = os.path.join(self.directory, f"{key}.json")
+        with open(f"{meta_path}.tmp", "w") as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(f"{meta_path}.tmp", meta_path)
+
+    # GET through a requests session, errors are passed through uncached for the caller to retry
+    def get(self, session, url, params=None):
+        key = self.key(url, params)
+        meta, content = self.read_entry(key)
+        now = time.time()
+        if meta is not None and meta["fresh_until"] > now:
+            return CachedResponse(200, meta["headers"], content, meta["content_hash"], True, 0)
+
+        response = session.get(url, params=params, headers=self.conditional_headers(meta))
+        if response.status_code == 304 and meta is not None:
+            self.revalidated(key, meta, response, now)
+            return CachedResponse(200, meta["headers"], content, meta["content_hash"], True, 0)
+        if response.status_code != 200:
+            return CachedResponse(response.status_code, dict(response.headers), response.content, None, False, len(response.content))
+
+        body = response.content
+        kept = {name: response.headers[name] for name in CACHED_HEADERS if response.headers.get(name)}
+        digest = content_hash(body)
+        if "no-store" not in parse_cache_control(kept.get("Cache-Control")):
+            self.write_entry(key, self.new_meta(url, kept, digest, now), body)
+        return CachedResponse(200, kept, body, digest, False, len(body))
+
+    # like get, but the body is read from response.raw while it arrives and written to the cache as it's consumed
+    # a downloaded body's content_hash is only known once the with block exits
+    @contextmanager
+    def stream(self, session, url, params=None):
+        key = self.key(url, params)
+        meta = self.read_meta(key)
+        body_path = os.path.join(self.directory, f"{key}.gz")
+        now = time.time()
+        if meta is not None and meta["fresh_until"] > now:
+            with gzip.open(body_path, "rb") as body_file:
+                yield CachedResponse(200, meta["headers"], None, meta["content_hash"], True, 0, body_file)
+            return
+
+        with session.get(url, params=params, headers=self.conditional_headers(meta), stream=True) as response:
+            if response.status_code == 304 and meta is not None:
+                self.revalidated(key, meta, response, now)
+                with gzip.open(body_path, "rb") as body_file:
+                    yield CachedResponse(200, meta["headers"], None, meta["content_hash"], True, 0, body_file)
+                return
+            if response.status_code != 200:
+                yield CachedResponse(response.status_code, dict(response.headers), response.content, None, False, len(response.content))
+                return
+
+            kept = {name: response.headers[name] for name in CACHED_HEADERS if response.headers.get(name)}
+            os.makedirs(self.directory, exist_ok=True)
+            tee = TeeReader(response.raw, body_path)
+            result = CachedResponse(200, kept, None, None, False, 0, tee)
+            try:
+                yield result
+            except BaseException:
+                tee.discard()
+                raise
+            result.content_hash = tee.finish()
+            result.downloaded = tee.bytes
+            if "no-store" in parse_cache_control(kept.get("Cache-Control")):
+                os.remove(body_path)
+            else:
+                self.write_entry(key, self.new_meta(url, kept, result.content_hash, now))
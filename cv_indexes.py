@@ -0,0 +1,210 @@
+import time
+from datetime import datetime
+import cv_config
+import cv_metrics
+
+# indexes the jobs rely on and the queries they serve, see cv-jobs.py indexes
+#   INDEXES - collection -> [(keys, options)], built with create_index (a no-op when the index exists)
+#   QUERIES - the finds the jobs issue, explained after the build. A hot query whose winning plan
+#             scans the collection fails the command
+INDEXES = {
+    "florida": [
+        ([("case_number", 1)], {"unique": True}),
+        ([("date_added", 1)], {}),
+        ([("county", 1), ("date_added", 1)], {}),
+        ([("travel", 1)], {}),
+        ([("location", "2dsphere")], {})
+    ],
+    "florida_daily_counts": [
+        ([("county", 1), ("date", 1)], {"unique": True})
+    ],
+    # cube cells are upserted by their key, see cv_cube.apply_deltas
+    "florida_cube": [
+        ([("county", 1), ("age_band", 1), ("sex", 1), ("date", 1)], {"unique": True}),
+        ([("date", 1)], {})
+    ],
+    "florida_cube_totals": [
+        ([("county", 1), ("age_band", 1), ("sex", 1), ("date", 1)], {"unique": True})
+    ],
+    "florida_growth": [
+        ([("series", 1), ("date", 1)], {})
+    ],
+    "other_stats": [
+        ([("date", 1)], {})
+    ]
+}
+
+# sample values, plans don't depend on them
+SINCE = datetime(2020, 3, 1)
+MIAMI = {"type": "Point", "coordinates": [-80.1918, 25.7617]}
+
+QUERIES = [
+    {"name": "max_case_number", "job": "cv.py", "collection": "florida",
+        "filter": {}, "sort": [("case_number", -1)], "limit": 1},
+    {"name": "under_investigation", "job": "cv.py", "collection": "florida",
+        "filter": {"travel": "Under Investigation"}},
+    {"name": "page_keys", "job": "cv_store.store_pages", "collection": "florida",
+        "filter": {"case_number": {"$in": list(range(1, 2001))}}},
+    {"name": "cases_since", "job": "cv_query.read_mongo", "collection": "florida",
+        "filter": {"date_added": {"$gte": SINCE}}},
+    {"name": "county_cases_since", "job": "dashboard", "collection": "florida",
+        "filter": {"county": "Dade", "date_added": {"$gte": SINCE}}},
+    {"name": "cases_near", "job": "dashboard", "collection": "florida",
+        "filter": {"location": {"$nearSphere": {"$geometry": MIAMI, "$maxDistance": 50000}}}, "limit": 100},
+    {"name": "daily_counts", "job": "cv_daily.read_daily_counts", "collection": "florida_daily_counts",
+        "filter": {"county": "All", "date": {"$lt": SINCE}}, "sort": [("date", 1)]},
+    {"name": "cube_cell", "job": "cv_cube.apply_deltas", "collection": "florida_cube",
+        "filter": {"county": "Dade", "county_code": 42, "age_band": "30-39", "sex": "Male", "date": SINCE}},
+    {"name": "latest_other_stats", "job": "cv-api.py", "collection": "other_stats",
+        "filter": {}, "sort": [("date", -1)], "limit": 1},
+    {"name": "last_published", "job": "cv-stats.py", "collection": "florida_growth",
+        "filter": {"series": "actual"}, "sort": [("date", -1)], "limit": 1}
+]
+
+def key_spec(keys):
+    return [(field, int(direction) if isinstance(direction, float) else direction) for field, direction in keys]
+
+# first key values stored more than once, None when every key is unique
+def duplicate_key(db, collection, keys):
+    pipeline = [
+        {"$group": {"_id": {field: f"${field}" for field, direction in keys}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$limit": 1}
+    ]
+    for row in db[collection].aggregate(pipeline, allowDiskUse=True):
+        return row["_id"]
+    return None
+
+# build the declared indexes of the given collections (all by default), returns the built names and the errors
+# an index on the same keys with other options (the old non-unique case_number one) is replaced. A unique replacement is
+# only built once the keys are unique, until then the old index stays in place
+def ensure_indexes(db, collections=None):
+    built = []
+    errors = []
+    for collection, indexes in INDEXES.items():
+        if collections is not None and collection not in collections:
+            continue
+        existing = db[collection].index_information()
+        for keys, options in indexes:
+            try:
+                replaced = [name for name, info in existing.items()
+                    if key_spec(info["key"]) == keys and any(info.get(option, False) != value for option, value in options.items())]
+                if len(replaced) > 0 and options.get("unique"):
+                    duplicate = duplicate_key(db, collection, keys)
+                    if duplicate is not None:
+                        raise ValueError(f"duplicate key {duplicate}, keeping index {', '.join(replaced)}")
+                for name in replaced:
+                    print(f"Dropping index {collection}.{name}, its options changed.")
+                    db[collection].drop_index(name)
+                built.append(f"{collection}.{db[collection].create_index(keys, **options)}")
+            except Exception as e:
+                errors.append(f"{collection} {keys}: {str(e)}")
+                print(f"Failed to build index on {collection} {keys}: {str(e)}")
+    return built, errors
+
+# build a collection's declared indexes and the other ones it has on target, e.g. a staging copy that is swapped in
+# with a rename (which drops the indexes of the collection it replaces)
+def copy_indexes(db, collection, target):
+    declared = INDEXES.get(collection, [])
+    indexes = list(declared)
+    for name, info in db[collection].index_information().items():
+        keys = key_spec(info["key"])
+        if name == "_id_" or any(keys == declared_keys for declared_keys, options in declared):
+            continue
+        indexes.append((keys, dict({option: value for option, value in info.items() if option not in ("key", "v", "ns")}, name=name)))
+    errors = []
+    for keys, options in indexes:
+        try:
+            db[target].create_index(keys, **options)
+        except Exception as e:
+            errors.append(f"{collection} {keys}: {str(e)}")
+            print(f"Failed to build index on {target} {keys}: {str(e)}")
+    return errors
+
+# stage names of a plan tree, newer servers nest the classic plan under queryPlan and sharded ones per shard
+def plan_stages(plan):
+    if not isinstance(plan, dict):
+        return []
+    stages = [plan["stage"]] if "stage" in plan else []
+    for key in ("inputStage", "queryPlan", "winningPlan", "outerStage", "innerStage"):
+        stages += plan_stages(plan.get(key))
+    for child in plan.get("inputStages", []) + plan.get("shards", []):
+        stages += plan_stages(child)
+    return stages
+
+def explain_query(db, query):
+    cursor = db[query["collection"]].find(query["filter"])
+    if "sort" in query:
+        cursor = cursor.sort(query["sort"])
+    if "limit" in query:
+        cursor = cursor.limit(query["limit"])
+    started = time.perf_counter()
+    explain = cursor.explain()
+    elapsed = time.perf_counter() - started
+    stages = plan_stages(explain.get("queryPlanner", {}).get("winningPlan"))
+    stats = explain.get("executionStats", {})
+    return {
+        "name": query["name"],
+        "job": query["job"],
+        "collection": query["collection"],
+        "hot": query.get("hot", True),
+        "plan": " <- ".join(stages),
+        "collection_scan": "COLLSCAN" in stages,
+        "execution_ms": stats.get("executionTimeMillis"),
+        "explain_ms": round(elapsed * 1000, 1),
+        "keys_examined": stats.get("totalKeysExamined"),
+        "docs_examined": stats.get("totalDocsExamined"),
+        "returned": stats.get("nReturned")
+    }
+
+# explain every query, report the plans and whether a hot one scans its collection or couldn't be explained
+def check_plans(db, metrics=None):
+    plans = []
+    for query in QUERIES:
+        try:
+            plans.append(explain_query(db, query))
+        except Exception as e:
+            print(f"Failed to explain {query['name']}: {str(e)}")
+            plans.append({"name": query["name"], "job": query["job"], "collection": query["collection"],
+                "hot": query.get("hot", True), "plan": "", "collection_scan": False, "error": str(e)})
+        if metrics is not None:
+            metrics.count("explain", "rows")
+
+    for plan in plans:
+        if "error" in plan:
+            continue
+        flag = "COLLSCAN" if plan["collection_scan"] and plan["hot"] else ""
+        print(f"{plan['name']:<22} {plan['collection']:<22} {plan['plan']:<40} "
+            f"{plan.get('execution_ms')} ms (explain {plan.get('explain_ms')} ms)  keys {plan.get('keys_examined')}  docs {plan.get('docs_examined')}  "
+            f"returned {plan.get('returned')}  ({plan['job']}) {flag}")
+
+    scans = [plan["name"] for plan in plans if plan["collection_scan"] and plan["hot"]]
+    failed = [plan["name"] for plan in plans if "error" in plan]
+    messages = []
+    if len(scans) > 0:
+        messages.append(f"Collection scans in hot queries: {', '.join(scans)}.")
+    if len(failed) > 0:
+        messages.append(f"Could not explain: {', '.join(failed)}.")
+    return {
+        "success": len(scans) == 0 and len(failed) == 0,
+        "message": " ".join(messages) if len(messages) > 0 else f"{len(plans)} query plans use indexes.",
+        "plans": plans
+    }
+
+# build the indexes and check the plans, see cv-jobs.py indexes
+def main(config=None, client=None):
+    config = config if config is not None else cv_config.load_config()
+    client = client if client is not None else cv_config.get_client(config)
+    db = client.get_database(config["mongodb"]["database"])
+    metrics = cv_metrics.Metrics("cv-indexes", config)
+    with metrics.stage("indexes"):
+        built, errors = ensure_indexes(db)
+        metrics.count("indexes", "rows", len(built))
+    with metrics.stage("explain"):
+        result = check_plans(db, metrics)
+    if len(errors) > 0:
+        result["success"] = False
+        result["message"] = f"{len(errors)} indexes failed to build. {result['message']}"
+    print(result["message"])
+    metrics.write(result["success"])
+    return result
@@ -0,0 +1,208 @@
+import io
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from pymongo import monitoring
+
+# prometheus_client is only needed for the textfile output
+try:
+    from prometheus_client import CollectorRegistry, Gauge, write_to_textfile
+except ImportError:
+    CollectorRegistry = None
+
+# per stage wall/CPU time and counters for the jobs
+#   <metrics_dir>/jobs.jsonl  - one JSON line per stage and run
+#   <metrics_dir>/<job>.prom  - gauges for the node_exporter textfile collector
+# stages nest, a stage's time excludes the stages run inside it (e.g. fetch and transform pulled through store)
+# profile "cprofile" or "tracemalloc" keeps a profile per stage and dumps the slowest one
+COUNTERS = ["rows", "bytes", "retries", "mongo_round_trips"]
+
+class Metrics():
+    # the metrics Mongo commands are counted against
+    active = None
+
+    def __init__(self, job, config=None):
+        other = (config or {}).get("other", {})
+        self.job = job
+        self.run_id = uuid.uuid4().hex[:12]
+        self.started = datetime.now()
+        self.directory = other.get("metrics_dir") or os.environ.get("METRICS_DIR", "./metrics")
+        self.profile = (other.get("profile") or os.environ.get("CV_PROFILE", "")).lower()
+        self.stages = {}
+        self.order = []
+        self.stack = []
+        self.lock = threading.Lock()
+        self.profiles = {}
+        if self.profile == "tracemalloc":
+            import tracemalloc
+            tracemalloc.start()
+        Metrics.active = self
+
+    def get_stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = dict({"wall_seconds": 0.0, "cpu_seconds": 0.0, "calls": 0}, **{counter: 0 for counter in COUNTERS})
+            self.order.append(name)
+        return self.stages[name]
+
+    # add to a counter of a stage, safe to call from worker threads
+    def count(self, stage, counter, value=1):
+        with self.lock:
+            self.get_stage(stage)[counter] += value
+
+    # counter of the stage currently running on the main thread
+    def count_current(self, counter, value=1):
+        stack = self.stack
+        self.count(stack[-1]["name"] if len(stack) > 0 else "other", counter, value)
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        frame = {"name": name, "child_wall": 0.0, "child_cpu": 0.0}
+        parent = self.stack[-1] if len(self.stack) > 0 else None
+        self.pause_profile(parent)
+        self.stack.append(frame)
+        self.start_profile(frame)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield frame
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            self.stop_profile(frame)
+            self.stack.pop()
+            with self.lock:
+                stage = self.get_stage(name)
+                stage["wall_seconds"] += wall - frame["child_wall"]
+                stage["cpu_seconds"] += cpu - frame["child_cpu"]
+                stage["calls"] += 1
+                if rows is not None:
+                    stage["rows"] += rows
+            if parent is not None:
+                parent["child_wall"] += wall
+                parent["child_cpu"] += cpu
+            self.resume_profile(parent)
+
+    # time each page pulled from a generator as the given stage
+    def pages(self, name, pages):
+        pages = iter(pages)
+        while True:
+            with self.stage(name):
+                page = next(pages, None)
+                if page is not None:
+                    self.count(name, "rows", len(page))
+            if page is None:
+                return
+            yield page
+
+    def start_profile(self, frame):
+        if self.profile == "cprofile":
+            import cProfile
+            profile = self.profiles.setdefault(frame["name"], cProfile.Profile())
+            profile.enable()
+        elif self.profile == "tracemalloc":
+            import tracemalloc
+            tracemalloc.reset_peak()
+
+    def stop_profile(self, frame):
+        if self.profile == "cprofile":
+            self.profiles[frame["name"]].disable()
+        elif self.profile == "tracemalloc":
+            import tracemalloc
+            peak = tracemalloc.get_traced_memory()[1]
+            previous = self.profiles.get(frame["name"])
+            if previous is None or peak >= previous[0]:
+                self.profiles[frame["name"]] = (peak, tracemalloc.take_snapshot())
+
+    # only one cProfile profiler can be enabled at a time
+    def pause_profile(self, frame):
+        if self.profile == "cprofile" and frame is not None:
+            self.profiles[frame["name"]].disable()
+
+    def resume_profile(self, frame):
+        if self.profile == "cprofile" and frame is not None:
+            self.profiles[frame["name"]].enable()
+
+    # write the structured log, the Prometheus textfile and the slowest stage's profile
+    def write(self, success=True):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self.write_log(success)
+            self.write_prometheus(success)
+            self.write_profile()
+        except Exception as e:
+            print(str(e))
+
+    def write_log(self, success):
+        with open(os.path.join(self.directory, "jobs.jsonl"), "a") as log_file:
+            for name in self.order:
+                log_file.write(json.dumps(dict({
+                    "time": datetime.now().isoformat(),
+                    "job": self.job,
+                    "run_id": self.run_id,
+                    "stage": name
+                }, **{field: round(value, 4) if isinstance(value, float) else value for field, value in self.stages[name].items()})) + "\n")
+            log_file.write(json.dumps({
+                "time": datetime.now().isoformat(),
+                "job": self.job,
+                "run_id": self.run_id,
+                "stage": None,
+                "success": success,
+                "wall_seconds": round((datetime.now() - self.started).total_seconds(), 4)
+            }) + "\n")
+
+    def write_prometheus(self, success):
+        if CollectorRegistry is None:
+            print("prometheus_client is not installed, skipping the textfile metrics.")
+            return
+        registry = CollectorRegistry()
+        gauges = {
+            "wall_seconds": Gauge("cv_job_stage_wall_seconds", "Wall time spent in the stage", ["job", "stage"], registry=registry),
+            "cpu_seconds": Gauge("cv_job_stage_cpu_seconds", "Process CPU time spent in the stage", ["job", "stage"], registry=registry)
+        }
+        for counter in COUNTERS:
+            gauges[counter] = Gauge(f"cv_job_stage_{counter}", f"{counter.replace('_', ' ').capitalize()} in the stage", ["job", "stage"], registry=registry)
+        for name, stage in self.stages.items():
+            for field, gauge in gauges.items():
+                gauge.labels(self.job, name).set(stage[field])
+        Gauge("cv_job_success", "1 if the last run succeeded", ["job"], registry=registry).labels(self.job).set(1 if success else 0)
+        Gauge("cv_job_last_run_timestamp_seconds", "Start of the last run", ["job"], registry=registry).labels(self.job).set(self.started.timestamp())
+        write_to_textfile(os.path.join(self.directory, f"{self.job}.prom"), registry)
+
+    def write_profile(self):
+        candidates = [name for name in self.order if name in self.profiles]
+        if self.profile not in ("cprofile", "tracemalloc") or len(candidates) == 0:
+            return
+        slowest = max(candidates, key=lambda name: self.stages[name]["wall_seconds"])
+        base = os.path.join(self.directory, f"{self.job}-{slowest}")
+        if self.profile == "cprofile":
+            import pstats
+            self.profiles[slowest].dump_stats(f"{base}.prof")
+            summary = io.StringIO()
+            pstats.Stats(self.profiles[slowest], stream=summary).sort_stats("cumulative").print_stats(25)
+            with open(f"{base}.txt", "w") as summary_file:
+                summary_file.write(summary.getvalue())
+        else:
+            peak, snapshot = self.profiles[slowest]
+            with open(f"{base}.tracemalloc.txt", "w") as summary_file:
+                summary_file.write(f"peak traced memory {peak / (1024 * 1024):.1f} MB\n")
+                for statistic in snapshot.statistics("lineno")[:25]:
+                    summary_file.write(f"{statistic}\n")
+        print(f"Wrote {self.profile} profile of the slowest stage ({slowest}) to {base}.*")
+
+# counts every command sent to MongoDB against the active metrics' current stage
+class MongoCommandCounter(monitoring.CommandListener):
+    def started(self, event):
+        if Metrics.active is not None:
+            Metrics.active.count_current("mongo_round_trips")
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+mongo_listener = MongoCommandCounter()
@@ -0,0 +1,212 @@
+import csv
+import json
+import os
+import re
+from datetime import datetime
+from functools import lru_cache
+import numpy as np
+import cv_cases
+import cv_counties
+
+# ijson is optional, without it the covidtracking feed is decoded in one piece
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# parsers for the case line CSV layouts, importable by process pool workers
+#   fldoh  - headerless 10 column FLDOH report layout (030262020.csv)
+#   export - mongoexport CSV of the florida collection (032720201717.csv)
+#   report - "line list of cases" pages of the FLDOH daily report PDFs (datasets/pdf)
+# and for the covidtracking.com states daily feed read by cv-api.py get_other_data
+FLDOH = "fldoh"
+EXPORT = "export"
+EXPORT_HEADER = "_id,case_number,county,age,sex,travel,travel_detail,contact_with_confirmed_case,date_added,deceased,location,hospitalized,ed_visit"
+
+# mongoexport doesn't escape the quotes inside JSON fields, so the csv module can't split these rows
+EXPORT_ROW = re.compile(
+    r'^ObjectId\("(?P<_id>[0-9a-f]{24})"\),(?P<case_number>[^,]*),(?P<county>[^,]*),(?P<age>[^,]*),(?P<sex>[^,]*),'
+    r'(?P<travel>[^,]*),(?:"(?P<travel_detail>\[.*?\])")?,(?P<contact_with_confirmed_case>[^,]*),'
+    r'(?:""(?P<date_added>[^"]*)"")?,(?P<deceased>[^,]*),(?:"(?P<location>\{.*?\})")?,(?P<hospitalized>[^,]*),(?P<ed_visit>[^,]*)$'
+)
+
+def detect_layout(file_name):
+    with open(file_name, "rb") as csv_file:
+        first_line = csv_file.readline().decode("utf-8-sig").strip()
+    return EXPORT if first_line.startswith("_id,case_number") else FLDOH
+
+# only a few hundred distinct dates appear in a file
+@lru_cache(maxsize=4096)
+def parse_fldoh_date(value):
+    return datetime.strptime(value, '%m/%d/%y')
+
+@lru_cache(maxsize=4096)
+def parse_export_date(value):
+    return datetime.strptime(value[:10], '%Y-%m-%d') if value else None
+
+# mongoexport repeats the same few dozen county locations
+@lru_cache(maxsize=4096)
+def parse_location(value):
+    return json.loads(value)
+
+@lru_cache(maxsize=4096)
+def parse_travel_detail(value):
+    return tuple(item.strip().title() if len(item.strip()) > 2 else item.strip() for item in value.split(";"))
+
+# embed_location - keep a copy of the county's location in the case, see cv_counties.embed_location
+def parse_fldoh_row(row, embed_location=True):
+    travel_detail = parse_travel_detail(row[5]) if row[5] else None
+    counties = cv_counties.registry()
+    code = counties.code(row[1])
+    case = {
+        "case_number": int(re.sub("[^0-9]", "", row[0])),
+        "county": row[1],
+        "county_code": code,
+        "age": int(re.sub("[^0-9]", "", row[2])) if row[2].strip() else 'Unknown',
+        "sex": row[3],
+        "travel": row[4],
+        "travel_detail": list(travel_detail) if travel_detail is not None else None,
+        "contact_with_confirmed_case": row[6] if row[6] else 'Unknown',
+        "jurisdiction": row[7],
+        "date_added": parse_fldoh_date(row[8]),
+        "deceased": row[9]
+    }
+    if embed_location:
+        case["location"] = counties.location(code)
+    return case
+
+def parse_export_line(line, embed_location=True):
+    match = EXPORT_ROW.match(line)
+    if match is None:
+        raise ValueError(f"Unrecognized export row: {line[:80]}")
+    fields = match.groupdict()
+    case = {
+        "case_number": int(fields["case_number"]),
+        "county": fields["county"],
+        "county_code": cv_counties.registry().code(fields["county"]),
+        "age": int(fields["age"]) if fields["age"].isdigit() else None,
+        "sex": fields["sex"],
+        "travel": fields["travel"],
+        "travel_detail": json.loads(fields["travel_detail"]) if fields["travel_detail"] else None,
+        "contact_with_confirmed_case": fields["contact_with_confirmed_case"],
+        "date_added": parse_export_date(fields["date_added"]),
+        "deceased": fields["deceased"],
+        "location": parse_location(fields["location"]) if fields["location"] else None,
+        "hospitalized": fields["hospitalized"] or None,
+        "ed_visit": fields["ed_visit"] or None
+    }
+    if not embed_location:
+        del case["location"]
+    return case
+
+# split a file into byte ranges that start and end on line boundaries
+def chunk_ranges(file_name, chunk_bytes, skip_header=False):
+    size = os.path.getsize(file_name)
+    ranges = []
+    with open(file_name, "rb") as csv_file:
+        start = 0
+        if skip_header:
+            csv_file.readline()
+            start = csv_file.tell()
+        while start < size:
+            csv_file.seek(min(start + chunk_bytes, size))
+            if csv_file.tell() < size:
+                csv_file.readline()
+            end = csv_file.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+# process pool worker: parse the cases in one byte range of a file, returned as a cv_cases.CaseTable
+def parse_chunk(file_name, layout, start, end, embed_location=True):
+    with open(file_name, "rb") as csv_file:
+        csv_file.seek(start)
+        lines = csv_file.read(end - start).decode("utf-8-sig").splitlines()
+
+    if layout == EXPORT:
+        return cv_cases.CaseTable.from_records([parse_export_line(line, embed_location) for line in lines if line.strip()])
+    return cv_cases.CaseTable.from_records([parse_fldoh_row(row, embed_location) for row in csv.reader(lines, delimiter=',') if row])
+
+# one case line of a daily report: case county age gender travel [detail] [contact] jurisdiction date
+REPORT_LINE = re.compile(
+    r'^(?P<case>\d[\d,]*) (?P<county>[A-Za-z][A-Za-z .\-]*?) (?:(?P<age>\d+|Unknown) )?(?P<sex>Male|Female|Unknown) '
+    r'(?P<travel>Yes|No|Unknown)(?: (?P<rest>.*?))? (?P<jurisdiction>FL resident|Non-FL resident|Not diagnosed/isolated in FL) '
+    r'(?P<date>\d\d/\d\d/\d\d)$'
+)
+
+# report line -> FLDOH CSV row, deaths are listed separately in the report so deceased is unknown
+def parse_report_line(line):
+    match = REPORT_LINE.match(line)
+    if match is None:
+        return None
+    fields = match.groupdict()
+    detail = (fields["rest"] or "").split(" ")
+    contact = ""
+    if detail[-1] in ("Yes", "No", "Unknown"):
+        contact = detail.pop()
+    age = fields["age"] if fields["age"] and fields["age"] != "Unknown" else ""
+    return [fields["case"], fields["county"], age, fields["sex"], fields["travel"], " ".join(detail), contact,
+        fields["jurisdiction"], fields["date"], "Unknown"]
+
+# process pool worker: cases from the line list pages in [start, end) of a report
+def parse_report_pages(file_name, start, end, embed_location=True):
+    import pdfplumber
+
+    cases = []
+    skipped = 0
+    with pdfplumber.open(file_name) as pdf:
+        for page in pdf.pages[start:end]:
+            lines = (page.extract_text() or "").split("\n")
+            if "line list of cases" not in lines[0]:
+                continue
+            for line in lines[1:]:
+                if not line[:1].isdigit():
+                    continue
+                row = parse_report_line(line)
+                if row is None:
+                    skipped += 1
+                else:
+                    cases.append(parse_fldoh_row(row, embed_location))
+    return cases, skipped
+
+# covidtracking daily feed: yield the items of the given states while the body is being read
+def iter_daily_items(stream, states):
+    items = ijson.items(stream, "item", use_float=True) if ijson is not None else json.load(stream)
+    for item in items:
+        if item.get("state") in states:
+            yield item
+
+def parse_daily_date(value):
+    return datetime.strptime(str(value), '%Y%m%d')
+
+# numeric field of every item as a float array, missing and null values are NaN
+def daily_column(items, field):
+    return np.array([item.get(field) for item in items], dtype=float)
+
+# ratio of today's total to yesterday's (total - increase), 0 where yesterday's total is unknown or zero
+def growth(total, increase):
+    previous = total - increase
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(previous > 0, total / previous, 0).tolist()
+
+# other_stats records for the days on or after since, growth fields are computed over all days at once
+def daily_records(items, since=None):
+    days = []
+    for item in items:
+        day = parse_daily_date(item["date"])
+        if since is None or day >= since:
+            days.append((day, item))
+    items = [item for day, item in days]
+    deaths_growth = growth(daily_column(items, "death"), daily_column(items, "deathIncrease"))
+    hospitalized_growth = growth(daily_column(items, "hospitalized"), daily_column(items, "hospitalizedIncrease"))
+    return [{
+        "date": day,
+        "tests": item["totalTestResults"] if "totalTestResults" in item else 0,
+        "new_tests": item.get("totalTestResultsIncrease"),
+        "deaths": item["death"] if "death" in item else 0,
+        "new_deaths": item.get("deathIncrease"),
+        "deaths_growth": deaths_growth[index],
+        "hospitalized": item["hospitalized"] if "hospitalized" in item else 0,
+        "new_hospitalized": item.get("hospitalizedIncrease"),
+        "hospitalized_growth": hospitalized_growth[index]
+    } for index, (day, item) in enumerate(days)]
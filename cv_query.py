@@ -0,0 +1,31 @@
+import pandas as pd
+
+# build a DataFrame column by column from a cursor of flat documents
+def cursor_to_frame(cursor, fields):
+    columns = {field: [] for field in fields}
+    for doc in cursor:
+        for field in fields:
+            columns[field].append(doc.get(field))
+
+    return pd.DataFrame(columns, columns=fields)
+
+# Convert MongoDB cursor to Pandas dataframe
+def read_mongo(db, collection, query={}, projection=None, no_id=True):
+    """ Read from Mongo and Store into DataFrame, only the projected fields are transferred """
+
+    if projection is None:
+        # Expand the cursor and construct the DataFrame
+        df = pd.DataFrame(list(db[collection].find(query)))
+        # Delete the _id
+        if no_id and '_id' in df:
+            del df['_id']
+        return df
+
+    fields = list(projection)
+    find_projection = {field: 1 for field in fields}
+    if no_id:
+        find_projection['_id'] = 0
+    elif '_id' not in fields:
+        fields.append('_id')
+
+    return cursor_to_frame(db[collection].find(query, find_projection, batch_size=10000), fields)
@@ -0,0 +1,129 @@
+import os
+from datetime import datetime, timedelta
+import numpy as np
+
+# rolling window analytics over prefix sums of daily counts
+# a PrefixSums holds rows x (days + 1) running totals, any window of any row is two lookups and adding a day is one
+# column. The sums are cached in <snapshot_dir>/rolling.npz, and a run only recomputes them from the first day whose
+# counts differ from the cache
+EPOCH = datetime(1970, 1, 1)
+CACHE_FILE = "rolling.npz"
+WINDOWS = [7, 14]
+
+# 10 year age bands, the last one is open ended
+AGE_BANDS = ["0-9", "10-19", "20-29", "30-39", "40-49", "50-59", "60-69", "70-79", "80+", "Unknown"]
+
+def age_band(age):
+    if not isinstance(age, int) or age < 0:
+        return len(AGE_BANDS) - 1
+    return min(age // 10, len(AGE_BANDS) - 2)
+
+def to_day(date):
+    return (date - EPOCH).days
+
+def from_day(day):
+    return EPOCH + timedelta(days=int(day))
+
+class PrefixSums():
+    def __init__(self, first_day, prefix):
+        self.first_day = first_day
+        self.prefix = prefix
+
+    @classmethod
+    def from_daily(cls, first_day, daily):
+        daily = np.asarray(daily, dtype=np.int64)
+        prefix = np.zeros((daily.shape[0], daily.shape[1] + 1), dtype=np.int64)
+        np.cumsum(daily, axis=1, out=prefix[:, 1:])
+        return cls(first_day, prefix)
+
+    @property
+    def days(self):
+        return self.prefix.shape[1] - 1
+
+    def daily(self):
+        return np.diff(self.prefix, axis=1)
+
+    # add one day of counts, one value per row
+    def append(self, counts):
+        self.prefix = np.concatenate([self.prefix, (self.prefix[:, -1] + np.asarray(counts, dtype=np.int64))[:, None]], axis=1)
+
+    # bring the sums in line with a new daily matrix, returns the index of the first day that changed
+    # only the days from there on are summed again
+    def update(self, first_day, daily):
+        daily = np.asarray(daily, dtype=np.int64)
+        if first_day != self.first_day or daily.shape[0] != self.prefix.shape[0]:
+            self.first_day = first_day
+            self.prefix = PrefixSums.from_daily(first_day, daily).prefix
+            return 0
+        known = min(self.days, daily.shape[1])
+        changed = np.flatnonzero((self.daily()[:, :known] != daily[:, :known]).any(axis=0))
+        start = int(changed[0]) if len(changed) > 0 else known
+        if start == daily.shape[1] and self.days == daily.shape[1]:
+            return start
+        prefix = self.prefix[:, :start + 1]
+        if start + 1 == daily.shape[1]:
+            self.prefix = prefix
+            self.append(daily[:, start])
+        else:
+            self.prefix = np.concatenate([prefix, prefix[:, -1:] + np.cumsum(daily[:, start:], axis=1)], axis=1)
+        return start
+
+    # running total through each of the given days
+    def total(self, ends):
+        return self.prefix[:, np.asarray(ends) + 1]
+
+    # sum over the `days` days ending on each of the given days, windows are cut off at the first day
+    def window(self, ends, days):
+        ends = np.asarray(ends)
+        return self.prefix[:, ends + 1] - self.prefix[:, np.maximum(ends + 1 - days, 0)]
+
+# cached sums per metric, {name: PrefixSums}
+def load_cache(directory):
+    cache_path = os.path.join(directory, CACHE_FILE)
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with np.load(cache_path) as cache:
+            names = [name[:-len("_prefix")] for name in cache.files if name.endswith("_prefix")]
+            return {name: PrefixSums(int(cache[f"{name}_first_day"]), cache[f"{name}_prefix"]) for name in names}
+    except Exception as e:
+        print(f"Ignoring the rolling sums cache: {str(e)}")
+        return {}
+
+def save_cache(directory, sums):
+    os.makedirs(directory, exist_ok=True)
+    arrays = {}
+    for name, prefix_sums in sums.items():
+        arrays[f"{name}_prefix"] = prefix_sums.prefix
+        arrays[f"{name}_first_day"] = np.int64(prefix_sums.first_day)
+    with open(os.path.join(directory, f"{CACHE_FILE}.tmp"), "wb") as cache_file:
+        np.savez(cache_file, **arrays)
+    os.replace(os.path.join(directory, f"{CACHE_FILE}.tmp"), os.path.join(directory, CACHE_FILE))
+
+# per row mean over each window, dividing by the days the window actually covers
+def window_mean(sums, ends, days):
+    covered = np.minimum(np.asarray(ends) + 1, days)
+    return sums.window(ends, days) / covered
+
+# days for the running total to double at the growth over the window, NaN when it isn't growing
+def doubling_days(sums, ends, days):
+    ends = np.asarray(ends)
+    current = sums.total(ends).astype(float)
+    previous = sums.prefix[:, np.maximum(ends + 1 - days, 0)].astype(float)
+    growing = (previous > 0) & (current > previous)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(growing, days * np.log(2) / np.log(np.where(growing, current / np.where(previous > 0, previous, 1), 2)), np.nan)
+
+# per 100,000 residents, NaN where the population isn't known
+def per_capita(values, population):
+    population = np.asarray(population, dtype=float)[:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(population > 0, values / population * 100000, np.nan)
+
+def ratio(numerator, denominator):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(denominator > 0, numerator / np.where(denominator > 0, denominator, 1), np.nan)
+
+# NaN -> None, rounded for publishing
+def clean(value, digits=2):
+    return None if value is None or np.isnan(value) else round(float(value), digits)
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import shutil
+from array import array
+from datetime import datetime, timedelta
+import numpy as np
+
+# local columnar copy of the florida collection for the analytics jobs
+#   <directory>/current.json          - manifest of the live snapshot
+#   <directory>/<version>/<column>.npy - one memory-mappable array per column
+EPOCH = datetime(1970, 1, 1)
+STATE_ID = "florida_snapshot"
+
+# numeric columns and their array typecodes, missing values are stored as -1
+NUMERIC = {
+    "case_number": "q",
+    "day": "i",
+    "age": "h",
+}
+
+# dictionary encoded columns, codes index into the manifest's dictionaries, -1 is missing
+CATEGORICAL = ["county", "sex", "travel", "contact_with_confirmed_case", "deceased", "hospitalized", "ed_visit"]
+
+def to_day(date_added):
+    return (date_added - EPOCH).days if isinstance(date_added, datetime) else -1
+
+def from_day(day):
+    return EPOCH + timedelta(days=int(day))
+
+def to_age(age):
+    return age if isinstance(age, int) else -1
+
+# stream the florida collection into typed arrays and save them as the new snapshot
+def write_snapshot(db, directory):
+    numeric = {column: array(typecode) for column, typecode in NUMERIC.items()}
+    codes = {column: array("h") for column in CATEGORICAL}
+    dictionaries = {column: {} for column in CATEGORICAL}
+    version = hashlib.sha1()
+
+    projection = dict({"_id": 0, "date_added": 1, "content_hash": 1, "case_number": 1, "age": 1}, **{column: 1 for column in CATEGORICAL})
+    for doc in db.florida.find({}, projection, batch_size=10000).sort("case_number", 1):
+        case_number = doc.get("case_number")
+        version.update(f"{case_number}:{doc.get('content_hash')};".encode("utf-8"))
+        numeric["case_number"].append(case_number if isinstance(case_number, int) else -1)
+        numeric["day"].append(to_day(doc.get("date_added")))
+        numeric["age"].append(to_age(doc.get("age")))
+        for column in CATEGORICAL:
+            value = doc.get(column)
+            if value is None:
+                codes[column].append(-1)
+            else:
+                codes[column].append(dictionaries[column].setdefault(value, len(dictionaries[column])))
+
+    version = version.hexdigest()
+    current = read_manifest(directory)
+    if current is not None and current["version"] == version:
+        print("Snapshot is up to date.")
+        # a writer may have invalidated it in between, the arrays still match florida
+        db.ingest_state.update_one({"_id": STATE_ID}, {"$set": {"version": version}}, upsert=True)
+        return version
+
+    # write the arrays next to the live snapshot, then flip the manifest
+    os.makedirs(directory, exist_ok=True)
+    target = os.path.join(directory, version)
+    shutil.rmtree(target, ignore_errors=True)
+    os.makedirs(target)
+    for column, values in numeric.items():
+        np.save(os.path.join(target, f"{column}.npy"), np.frombuffer(values, dtype=values.typecode) if len(values) else np.array([], dtype=values.typecode))
+    for column, values in codes.items():
+        np.save(os.path.join(target, f"{column}.npy"), np.frombuffer(values, dtype=np.int16) if len(values) else np.array([], dtype=np.int16))
+
+    manifest = {
+        "version": version,
+        "rows": len(numeric["case_number"]),
+        "created": datetime.now().isoformat(),
+        "dictionaries": {column: list(values.keys()) for column, values in dictionaries.items()}
+    }
+    with open(os.path.join(directory, "current.json.tmp"), "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(os.path.join(directory, "current.json.tmp"), os.path.join(directory, "current.json"))
+
+    # older versions are no longer referenced
+    for entry in os.listdir(directory):
+        if entry != version and os.path.isdir(os.path.join(directory, entry)):
+            shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+
+    db.ingest_state.update_one({"_id": STATE_ID}, {"$set": {"version": version, "updated": datetime.now()}}, upsert=True)
+    print(f"Wrote snapshot {version} with {manifest['rows']} cases.")
+    return version
+
+def read_manifest(directory):
+    manifest_path = os.path.join(directory, "current.json")
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+# florida changed outside of a snapshot write, the stats jobs read MongoDB until the next snapshot
+def invalidate(db):
+    db.ingest_state.update_one({"_id": STATE_ID}, {"$unset": {"version": ""}})
+
+# load the snapshot if it matches the version recorded by the last ingest, None otherwise
+def load_current(db, directory):
+    manifest = read_manifest(directory)
+    if manifest is None:
+        return None
+    state = db.ingest_state.find_one({"_id": STATE_ID}, {"version": 1})
+    if state is None or state.get("version") != manifest["version"]:
+        print("Snapshot is stale, falling back to MongoDB.")
+        return None
+    return Snapshot(directory, manifest)
+
+# memory-mapped view of a snapshot
+class Snapshot():
+    def __init__(self, directory, manifest):
+        self.version = manifest["version"]
+        self.rows = manifest["rows"]
+        self.dictionaries = manifest["dictionaries"]
+        self.columns = {}
+        for column in list(NUMERIC.keys()) + CATEGORICAL:
+            self.columns[column] = np.load(os.path.join(directory, self.version, f"{column}.npy"), mmap_mode="r")
+
+    # cases as a DataFrame, dictionary encoded columns become Categoricals
+    def to_frame(self):
+        import pandas as pd
+        frame = pd.DataFrame({
+            "case_number": self.columns["case_number"],
+            "date_added": pd.to_datetime(np.where(self.columns["day"] >= 0, self.columns["day"], np.nan), unit="D", origin="unix"),
+            "age": pd.Series(self.columns["age"]).where(self.columns["age"] >= 0)
+        })
+        for column in CATEGORICAL:
+            frame[column] = pd.Categorical.from_codes(np.asarray(self.columns[column]), categories=self.dictionaries[column])
+        return frame
+
+    # statewide rows of date/count, same shape as cv_daily.read_daily_counts
+    def daily_counts(self, before=None):
+        days = self.columns["day"]
+        days = days[days >= 0]
+        if len(days) == 0:
+            return []
+        first = int(days.min())
+        counts = np.bincount(days - first)
+        rows = [{"date": from_day(first + offset), "count": int(count)} for offset, count in enumerate(counts) if count > 0]
+        return [row for row in rows if before is None or row["date"] < before]
+
+    # per county rows of date/county/count, same shape as cv_daily.read_county_counts
+    def county_counts(self, before=None):
+        valid = (self.columns["day"] >= 0) & (self.columns["county"] >= 0)
+        days = self.columns["day"][valid]
+        counties = self.columns["county"][valid].astype(np.int64)
+        if len(days) == 0:
+            return []
+        first = int(days.min())
+        span = int(days.max()) - first + 1
+        counts = np.bincount(counties * span + (days - first), minlength=len(self.dictionaries["county"]) * span)
+        rows = []
+        for cell in np.flatnonzero(counts):
+            date = from_day(first + cell % span)
+            if before is None or date < before:
+                rows.append({"date": date, "county": self.dictionaries["county"][cell // span], "count": int(counts[cell])})
+        return rows
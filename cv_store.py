@@ -0,0 +1,190 @@
+import hashlib
+import json
+from pymongo import InsertOne, ReplaceOne, DeleteMany
+import cv_cases
+import cv_snapshot
+import cv_indexes
+
+# content hash of a record, ignoring the Mongo _id and the hash itself
+def hash_record(record):
+    content = {field: value for field, value in record.items() if field not in ("_id", "content_hash")}
+    encoded = json.dumps(content, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha1(encoded).hexdigest()
+
+# pages are lists of dicts or cv_cases.CaseTable, tables are hashed column-wise and written as raw BSON
+def page_hashes(records):
+    if isinstance(records, cv_cases.CaseTable):
+        return records.content_hashes()
+    for record in records:
+        record["content_hash"] = hash_record(record)
+    return [record["content_hash"] for record in records]
+
+def page_keys(records, key):
+    if isinstance(records, cv_cases.CaseTable):
+        return records.values(key)
+    return [record[key] for record in records]
+
+# RawBSONDocument needs the real driver, stand-ins like mongomock get dicts
+def raw_bson(db):
+    return type(db.client).__module__.split(".")[0] == "pymongo"
+
+def documents(db, records):
+    if isinstance(records, cv_cases.CaseTable):
+        return records.documents() if raw_bson(db) else records.to_records()
+    return records
+
+# several observers of one store_pages call, e.g. the daily counts and the dashboard cube of the florida collection
+# any change also invalidates the columnar snapshot, writers that refresh it do so after apply
+class Trackers():
+    def __init__(self, *trackers):
+        self.trackers = trackers
+        self.fields = list(dict.fromkeys(field for tracker in trackers for field in tracker.fields))
+        self.changed = False
+
+    def added(self, doc):
+        self.changed = True
+        for tracker in self.trackers:
+            tracker.added(doc)
+
+    def removed(self, doc):
+        self.changed = True
+        for tracker in self.trackers:
+            tracker.removed(doc)
+
+    def rebuild(self):
+        self.changed = True
+        for tracker in self.trackers:
+            tracker.rebuild()
+
+    def apply(self, db):
+        if self.changed:
+            cv_snapshot.invalidate(db)
+        for tracker in self.trackers:
+            tracker.apply(db)
+
+# sync records into a collection, keyed by a unique field
+#   mode "diff"    - only insert/replace/delete documents whose content hash changed, stored documents without a
+#                    hash count as changed
+#   mode "rebuild" - write everything to a staging collection and swap it in with a rename
+#   partial       - records are a subset of the collection, never delete missing keys
+#   tracker       - optional observer told about added/removed documents, see cv_daily.DailyCountTracker and Trackers
+def store_data(db, records, collection, key, mode="diff", partial=False, tracker=None):
+    return store_pages(db, [records], collection, key, mode, partial, tracker)
+
+# same as store_data but consumes an iterable of record pages, writing one page at a time
+def store_pages(db, pages, collection, key, mode="diff", partial=False, tracker=None):
+    try:
+        target = db.get_collection(collection)
+        if not partial and mode == "rebuild":
+            result = rebuild_pages(db, pages, collection)
+            if result["success"] and tracker is not None:
+                tracker.rebuild()
+                tracker.apply(db)
+            return result
+
+        tracked_fields = {field: 1 for field in tracker.fields} if tracker is not None else {}
+
+        raw = raw_bson(db)
+        seen = set()
+        inserted = updated = 0
+        for records in pages:
+            hashes = page_hashes(records)
+            # rows of a table are only encoded when they are written
+            if isinstance(records, cv_cases.CaseTable):
+                document = records.document if raw else records.record
+                row = records.__getitem__
+            else:
+                document = row = records.__getitem__
+
+            # key -> stored document (_id, content_hash and tracked fields) for this page
+            existing = {}
+            keys = page_keys(records, key)
+            for doc in target.find({key: {"$in": keys}}, dict({key: 1, "content_hash": 1}, **tracked_fields)):
+                existing.setdefault(doc[key], doc)
+
+            operations = []
+            for index, record_key in enumerate(keys):
+                if record_key in seen:
+                    print(f"Skipping duplicate {key} {record_key}.")
+                    continue
+                seen.add(record_key)
+                if record_key not in existing:
+                    operations.append(InsertOne(document(index)))
+                    inserted += 1
+                    if tracker is not None:
+                        tracker.added(row(index))
+                elif existing[record_key].get("content_hash") != hashes[index]:
+                    operations.append(ReplaceOne({"_id": existing[record_key]["_id"]}, document(index)))
+                    updated += 1
+                    if tracker is not None:
+                        tracker.removed(existing[record_key])
+                        tracker.added(row(index))
+
+            if len(operations) > 0:
+                target.bulk_write(operations, ordered=False)
+
+        # anything not seen in the source (and duplicate keys) goes away
+        removed = []
+        if not partial:
+            stored = set()
+            for doc in target.find({}, dict({key: 1}, **tracked_fields)):
+                if doc.get(key) not in seen or doc.get(key) in stored:
+                    removed.append(doc["_id"])
+                    if tracker is not None:
+                        tracker.removed(doc)
+                stored.add(doc.get(key))
+            if len(removed) > 0:
+                target.bulk_write([DeleteMany({"_id": {"$in": removed}})], ordered=False)
+
+        print(f"Synced collection {collection}: {inserted} new, {updated} changed, {len(removed)} removed.")
+        if tracker is not None:
+            tracker.apply(db)
+
+    except Exception as e:
+        print(str(e))
+        return {
+            "success": False,
+            "message": str(e)
+        }
+
+    return {
+        "success": True,
+        "message": "",
+        "inserted": inserted,
+        "updated": updated,
+        "deleted": len(removed)
+    }
+
+# full rebuild through a staging collection, readers never see a partial collection
+def rebuild_pages(db, pages, collection):
+    staging = db.get_collection(f"{collection}_staging")
+    try:
+        current_count = db.get_collection(collection).estimated_document_count()
+        staging.drop()
+        print(f"Rebuilding collection {collection}.")
+        count = 0
+        for records in pages:
+            page_hashes(records)
+            if len(records) > 0:
+                staging.insert_many(documents(db, records), ordered=False)
+                count += len(records)
+        if count > 0:
+            # the rename drops the live collection's indexes, build them on the copy first
+            cv_indexes.copy_indexes(db, collection, staging.name)
+            staging.rename(collection, dropTarget=True)
+        else:
+            db.get_collection(collection).delete_many({})
+    except Exception as e:
+        print(str(e))
+        return {
+            "success": False,
+            "message": str(e)
+        }
+
+    return {
+        "success": True,
+        "message": "",
+        "inserted": max(0, count - current_count),
+        "updated": 0,
+        "deleted": 0
+    }
@@ -0,0 +1,87 @@
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import cv_cases
+
+# document fields in the order they are stored, see cv_cases.CaseTable
+# location is left out unless it's embedded, see cv_counties.embed_location
+FIELDS = [
+    "case_number", "county", "county_code", "age", "sex", "travel", "travel_detail", "contact_with_confirmed_case",
+    "date_added", "deceased", "location", "hospitalized", "ed_visit"
+]
+
+# "italy; NY" -> ["Italy", "NY"]
+def parse_origin(origin):
+    if origin is None or origin == "NA":
+        return None
+    return [ item.strip().title() if len(item.strip()) > 2 else item.strip() for item in origin.split(";") ]
+
+def parse_age(age):
+    return int(age) if (age != "NA" and age is not None) else None
+
+def parse_contact(contact):
+    if contact is None:
+        return None
+    return contact.title() if contact != "NA" else "No"
+
+# Case1 is epoch milliseconds, cases are counted by local calendar day
+def parse_case_date(case1):
+    if case1 is None:
+        return None
+    return datetime.fromtimestamp(case1 / 1000.0).replace(hour=0, minute=0, second=0, microsecond=0)
+
+def parse_deceased(died):
+    return died if died != "NA" else "No"
+
+def parse_yes_no(value):
+    return value.title() if (value is not None and value != "NA") else None
+
+# apply fn once per distinct value of a column, returning the codes and the mapped values
+def map_unique(column, fn):
+    codes, uniques = pd.factorize(column)
+    mapped = np.empty(len(uniques) + 1, dtype=object)
+    for i, value in enumerate(uniques):
+        mapped[i] = fn(value)
+    # factorize marks missing values with -1, which picks the last slot
+    mapped[-1] = fn(None)
+    return codes, mapped
+
+# build a table of cases from a page of ArcGIS features, one column at a time
+#   counties - cv_counties.CountyRegistry the county codes and locations come from
+def transform_features(features, counties, embed_location=True):
+    table = cv_cases.CaseTable([field for field in FIELDS if embed_location or field != "location"])
+    if len(features) == 0:
+        return table
+
+    attributes = [row["attributes"] for row in features]
+    def column(field):
+        return np.array([row[field] for row in attributes], dtype=object)
+
+    # county name, code and location share one set of codes
+    county_codes, names = map_unique(column("County"), lambda county: county)
+    codes = np.array([counties.code(name) for name in names], dtype=object)
+
+    columns = {
+        "case_number": (np.arange(len(attributes)), [row["ObjectId"] for row in attributes]),
+        "county": (county_codes, names),
+        "county_code": (county_codes, codes),
+        "age": map_unique(column("Age"), parse_age),
+        "sex": map_unique(column("Gender"), lambda sex: sex),
+        "travel": map_unique(column("Travel_related"), lambda travel: travel),
+        "travel_detail": map_unique(column("Origin"), parse_origin),
+        "contact_with_confirmed_case": map_unique(column("Contact"), parse_contact),
+        "date_added": map_unique(column("Case1"), parse_case_date),
+        "deceased": map_unique(column("Died"), parse_deceased),
+        "hospitalized": map_unique(column("Hospitalized"), parse_yes_no),
+        "ed_visit": map_unique(column("EDvisit"), parse_yes_no),
+    }
+    if embed_location:
+        columns["location"] = (county_codes, np.array([counties.location(code) for code in codes], dtype=object))
+    table.extend_factorized(columns)
+    return table
+
+# highest ObjectId and Case1 in a page of features
+def high_water_mark(features):
+    max_object_id = max((row["attributes"]["ObjectId"] for row in features), default=0)
+    max_case1 = max((row["attributes"]["Case1"] or 0 for row in features), default=0)
+    return max_object_id, max_case1
@@ -0,0 +1,96 @@
+from datetime import datetime
+import pytest
+import cv_cases
+import cv_cube
+import cv_daily
+import cv_store
+
+mongomock = pytest.importorskip("mongomock")
+
+def case(case_number, county="Dade", day=2, age=40, sex="Male", **outcomes):
+    return dict({"case_number": case_number, "county": county, "age": age, "sex": sex,
+        "date_added": datetime(2020, 3, day, 10, 30), "hospitalized": "No", "deceased": "No", "ed_visit": "No",
+        "travel": "No"}, **outcomes)
+
+CASES = [
+    case(1),
+    case(2, day=3),
+    case(3, county="Broward", hospitalized="Yes"),
+    case(4, county="Broward", day=4, age=71, sex="Female", deceased="Yes"),
+    # the only case of its day, county and cell
+    case(5, county="Monroe", day=5, age=12, sex="Female", travel="Yes"),
+    case(6, age=None, ed_visit="Yes")
+]
+
+def sync(db, records, as_table, partial=False):
+    page = cv_cases.CaseTable.from_records(records) if as_table else [dict(record) for record in records]
+    tracker = cv_store.Trackers(cv_daily.DailyCountTracker(), cv_cube.CubeTracker())
+    return cv_store.store_data(db, page, "florida", "case_number", partial=partial, tracker=tracker)
+
+def contents(collection):
+    return sorted((doc for doc in collection.find({}, {"_id": 0})), key=lambda doc: sorted(doc.items(), key=str))
+
+# the counts and cubes maintained with deltas, compared to the ones rebuilt from the same florida collection
+def assert_matches_rebuild(db):
+    maintained = [contents(db[name]) for name in (cv_daily.COLLECTION, cv_cube.COLLECTION, cv_cube.TOTALS)]
+    cv_daily.rebuild_daily_counts(db)
+    cv_cube.rebuild_cube(db)
+    assert maintained == [contents(db[name]) for name in (cv_daily.COLLECTION, cv_cube.COLLECTION, cv_cube.TOTALS)]
+
+def first_sync(db, as_table):
+    result = sync(db, CASES, as_table)
+    assert result["inserted"] == len(CASES)
+    cv_daily.clear_dirty(db, cv_daily.get_dirty_from(db))
+    assert cv_daily.get_dirty_from(db) is None
+
+@pytest.mark.parametrize("as_table", [False, True])
+def test_first_sync_builds_counts_and_cube(as_table):
+    db = mongomock.MongoClient().test
+    sync(db, CASES, as_table)
+    assert db[cv_daily.COLLECTION].find_one({"county": cv_daily.STATEWIDE, "date": datetime(2020, 3, 2)})["count"] == 3
+    assert sum(doc["cases"] for doc in db[cv_cube.TOTALS].find()) == len(CASES)
+    assert_matches_rebuild(db)
+
+@pytest.mark.parametrize("as_table", [False, True])
+def test_deltas_match_rebuild(as_table):
+    db = mongomock.MongoClient().test
+    first_sync(db, as_table)
+
+    records = [
+        # county and date change
+        case(1, county="Broward", day=4),
+        case(2, day=6),
+        # an outcome changes, the cell stays
+        case(3, county="Broward", hospitalized="Yes", deceased="Recent"),
+        case(4, county="Broward", day=4, age=71, sex="Female", deceased="Yes"),
+        case(6, age=None, ed_visit="Yes"),
+        case(7, county="Dade", day=6, age=85)
+    ]
+    result = sync(db, records, as_table)
+    assert (result["inserted"], result["updated"], result["deleted"]) == (1, 3, 1)
+    # case 1 moved away from March 2nd
+    assert cv_daily.get_dirty_from(db) == datetime(2020, 3, 2)
+
+    # case 5 was removed, its day and cell are gone rather than left at zero
+    assert db[cv_daily.COLLECTION].find_one({"county": "Monroe"}) is None
+    assert db[cv_cube.COLLECTION].find_one({"county": "Monroe"}) is None
+    assert db[cv_cube.TOTALS].find_one({"county": "Monroe"}) is None
+    assert db[cv_cube.COLLECTION].find_one({"county": "Broward", "date": datetime(2020, 3, 2)})["deceased"] == 1
+    assert_matches_rebuild(db)
+
+def test_partial_sync_deltas_match_rebuild():
+    db = mongomock.MongoClient().test
+    first_sync(db, False)
+    result = sync(db, [case(2, county="Monroe", day=5, age=12, sex="Female"), case(8, day=1)], False, partial=True)
+    assert (result["inserted"], result["updated"], result["deleted"]) == (1, 1, 0)
+    assert cv_daily.get_dirty_from(db) == datetime(2020, 3, 1)
+    assert db[cv_cube.COLLECTION].find_one({"county": "Monroe"})["cases"] == 2
+    assert_matches_rebuild(db)
+
+def test_unchanged_sync_leaves_counts_alone():
+    db = mongomock.MongoClient().test
+    first_sync(db, False)
+    result = sync(db, CASES, False)
+    assert (result["inserted"], result["updated"], result["deleted"]) == (0, 0, 0)
+    assert cv_daily.get_dirty_from(db) is None
+    assert_matches_rebuild(db)
@@ -0,0 +1,117 @@
+from datetime import datetime
+import bson
+import numpy as np
+import pytest
+import cv_cases
+import cv_rolling
+import cv_store
+
+mongomock = pytest.importorskip("mongomock")
+
+# covers every kind of column value: plain and out of range integers, values that aren't integers, days and datetimes
+# with a time of day, None, lists and nested dicts
+RECORDS = [
+    {"case_number": 1, "county": "Dade", "county_code": 12, "age": 34, "sex": "Male", "date_added": datetime(2020, 3, 2),
+        "travel_detail": ["NY", "PA"], "location": {"type": "Point", "coordinates": [-80.5, 25.6]}, "ed_visit": None},
+    {"case_number": 2 ** 40, "county": "Broward", "county_code": 5, "age": "Unknown", "sex": "Female",
+        "date_added": datetime(2020, 3, 2, 14, 30), "travel_detail": None, "location": None, "ed_visit": "Yes"},
+    {"case_number": 3, "county": "Unknown", "county_code": -1, "age": None, "sex": "Male", "date_added": None,
+        "travel_detail": [], "location": {"coordinates": [-82.1, 27.0], "type": "Point"}, "ed_visit": "No"},
+    {"case_number": -2 ** 63 + 5, "county": "Dade", "county_code": 12, "age": 2 ** 20, "sex": "Male",
+        "date_added": datetime(1960, 1, 1), "travel_detail": ["NY", "PA"], "location": None, "ed_visit": None}
+]
+
+def case(case_number, **fields):
+    return dict({"case_number": case_number, "county": "Dade", "age": 40, "date_added": datetime(2020, 3, case_number % 28 + 1)}, **fields)
+
+def test_table_hashes_match_hash_record():
+    table = cv_cases.CaseTable.from_records(RECORDS)
+    assert table.content_hashes() == [cv_store.hash_record(record) for record in RECORDS]
+
+def test_table_documents_match_bson_encode():
+    table = cv_cases.CaseTable.from_records(RECORDS)
+    hashes = table.content_hashes()
+    for index, record in enumerate(RECORDS):
+        expected = dict(record, content_hash=hashes[index])
+        assert table.document(index).raw == bson.encode(expected)
+        assert table.record(index) == expected
+
+def test_take_keeps_hashes():
+    table = cv_cases.CaseTable.from_records(RECORDS)
+    hashes = table.content_hashes()
+    subset = table.take([3, 1])
+    assert subset.content_hashes() == [hashes[3], hashes[1]]
+    assert subset.to_records() == [dict(RECORDS[index], content_hash=hashes[index]) for index in (3, 1)]
+
+@pytest.mark.parametrize("as_table", [False, True])
+def test_diff_sync_counts(as_table):
+    db = mongomock.MongoClient().test
+
+    def sync(records):
+        page = cv_cases.CaseTable.from_records(records) if as_table else [dict(record) for record in records]
+        return cv_store.store_data(db, page, "florida", "case_number")
+
+    records = [case(number) for number in range(1, 6)]
+    result = sync(records)
+    assert (result["inserted"], result["updated"], result["deleted"]) == (5, 0, 0)
+
+    result = sync(records)
+    assert (result["inserted"], result["updated"], result["deleted"]) == (0, 0, 0)
+
+    # change one, drop one and add one
+    changed = [case(1, age=41)] + records[1:4] + [case(6)]
+    result = sync(changed)
+    assert (result["inserted"], result["updated"], result["deleted"]) == (1, 1, 1)
+    assert sorted(doc["case_number"] for doc in db.florida.find()) == [1, 2, 3, 4, 6]
+    assert db.florida.find_one({"case_number": 1})["age"] == 41
+
+def test_unhashed_documents_count_as_changed():
+    db = mongomock.MongoClient().test
+    records = [case(number) for number in range(1, 4)]
+    db.florida.insert_many([dict(record) for record in records])
+    result = cv_store.store_data(db, [dict(record) for record in records], "florida", "case_number")
+    assert (result["inserted"], result["updated"], result["deleted"]) == (0, 3, 0)
+    assert db.florida.count_documents({"content_hash": {"$exists": False}}) == 0
+
+def test_partial_sync_keeps_missing_keys():
+    db = mongomock.MongoClient().test
+    cv_store.store_data(db, [case(number) for number in range(1, 4)], "florida", "case_number")
+    result = cv_store.store_data(db, [case(4)], "florida", "case_number", partial=True)
+    assert (result["inserted"], result["deleted"]) == (1, 0)
+    assert db.florida.count_documents({}) == 4
+
+def daily_counts(days, rows=3, seed=1):
+    return np.random.default_rng(seed).integers(0, 9, (rows, days))
+
+def test_prefix_sums_append_days():
+    daily = daily_counts(30)
+    sums = cv_rolling.PrefixSums.from_daily(100, daily[:, :20])
+    assert sums.update(100, daily) == 20
+    assert np.array_equal(sums.prefix, cv_rolling.PrefixSums.from_daily(100, daily).prefix)
+
+def test_prefix_sums_change_in_the_past():
+    daily = daily_counts(30)
+    sums = cv_rolling.PrefixSums.from_daily(100, daily)
+    changed = daily.copy()
+    changed[1, 12] += 3
+    assert sums.update(100, changed) == 12
+    assert np.array_equal(sums.daily(), changed)
+    # nothing changed since
+    assert sums.update(100, changed) == 30
+
+def test_prefix_sums_new_first_day_or_rows_start_over():
+    daily = daily_counts(10)
+    sums = cv_rolling.PrefixSums.from_daily(100, daily)
+    assert sums.update(99, daily) == 0
+    assert sums.first_day == 99
+    assert sums.update(99, daily_counts(10, rows=4)) == 0
+    assert sums.prefix.shape == (4, 11)
+
+def test_prefix_sums_windows():
+    daily = daily_counts(30)
+    sums = cv_rolling.PrefixSums.from_daily(100, daily)
+    ends = np.arange(30)
+    windows = sums.window(ends, 7)
+    for end in (0, 3, 6, 7, 29):
+        assert np.array_equal(windows[:, end], daily[:, max(0, end - 6):end + 1].sum(axis=1))
+    assert np.array_equal(sums.total(ends), np.cumsum(daily, axis=1))